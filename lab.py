@@ -25,69 +25,218 @@ MY_COIN     = "YOUR_SYMBOL"          # ← change this to YOUR coin's ticker sym
 # ═══════════════════════════════════════════════════════════
 
 import sqlite3
-import os
+import sys
 
-# Find the database file
 DB_FILE = "classusd.db"
-if not os.path.exists(DB_FILE):
-    print(f"ERROR: Cannot find '{DB_FILE}'")
+
+# One-time setup on the database file. Indexes on the columns the JOINs
+# below match on — without these, every JOIN has to scan the whole table
+# (try EXPLAIN QUERY PLAN to see SEARCH USING INDEX instead of SCAN).
+# idx_lb_chain also stores the hashes, so a coin's whole chain can be read
+# from the index alone (a COVERING INDEX). They have the same names and
+# columns as the indexes server.py makes, so neither program builds a
+# second copy of the other's. No index on balances(user_id) is needed:
+# UNIQUE(user_id, coin_id) already gives it one. The executed_at indexes are
+# kept newest-first, so "ORDER BY executed_at DESC" (1C, 2A) reads rows
+# already in order instead of sorting every trade. ANALYZE collects table
+# statistics so SQLite picks good JOIN orders — it only needs to run once.
+#
+# mode=rw means "the file must already exist": if it's missing, SQLite
+# reports an error instead of quietly creating an empty database.
+try:
+    setup = sqlite3.connect(f"file:{DB_FILE}?mode=rw", uri=True, isolation_level=None)
+except sqlite3.OperationalError:
+    print(f"ERROR: Cannot open '{DB_FILE}'")
     print(f"Make sure classusd.db is in the same folder as this file.")
     print(f"Download it from the exchange site using the ⬇ DB button.")
     exit()
 
-# Connect to the database
-conn = sqlite3.connect(DB_FILE)
-conn.row_factory = sqlite3.Row   # lets you access columns by name (like row["amount"])
+# The indexes only make queries faster. If they can't be written (the
+# file is read-only, or the server or DB Browser has it locked), say why
+# and carry on without them.
+try:
+    setup.executescript("""
+        CREATE INDEX IF NOT EXISTS idx_trades_from_time ON trades(from_user_id, executed_at DESC);
+        CREATE INDEX IF NOT EXISTS idx_trades_to_time   ON trades(to_user_id, executed_at DESC);
+        CREATE INDEX IF NOT EXISTS idx_trades_time      ON trades(executed_at DESC);
+        CREATE INDEX IF NOT EXISTS idx_trades_coin      ON trades(coin_id);
+        CREATE INDEX IF NOT EXISTS idx_balances_coin    ON balances(coin_id, amount DESC);
+        CREATE INDEX IF NOT EXISTS idx_lb_trade         ON ledger_blocks(trade_id);
+        CREATE INDEX IF NOT EXISTS idx_lb_chain         ON ledger_blocks(coin_id, block_id,
+                                                           prev_hash, this_hash, trade_id);
+    """)
+    if not setup.execute("SELECT 1 FROM sqlite_master WHERE name='sqlite_stat1'").fetchone():
+        setup.execute("ANALYZE")
+    setup.execute("PRAGMA optimize")
+except sqlite3.Error as e:
+    print(f"NOTE: Couldn't add indexes to '{DB_FILE}' ({e}).")
+    print(f"The lab still runs, some queries are just slower.")
+finally:
+    setup.close()
+
+# Connect to the database — READ-ONLY from here on.
+# mode=ro still reads the -wal file, so trades the exchange server has
+# committed but not yet copied into classusd.db show up here too.
+# cached_statements keeps every query in this lab compiled after its first
+# run, so SQLite doesn't re-parse the same SQL text each time.
+# Rows come back as plain tuples (row[0], row[1], ...), which sqlite3
+# builds directly in C — run_query gets the column names separately.
+conn = sqlite3.connect(f"file:{DB_FILE}?mode=ro", uri=True,
+                       cached_statements=512, isolation_level=None)
 cur  = conn.cursor()
 
-print("=" * 55)
-print("  CLASSUSD SQL Lab")
-print(f"  Student: {MY_USERNAME}  |  Coin: {MY_COIN}")
-print("=" * 55)
+# Speed settings: memory-mapped reads, a bigger page cache, and helper
+# tables kept in memory.
+cur.executescript("""
+    PRAGMA temp_store=MEMORY;
+    PRAGMA mmap_size=268435456;
+    PRAGMA cache_size=-65536;
+""")
+
+# A small helper table for showing names: every user, plus an extra row
+# user_id 0 = 'SYSTEM' for trades that came from the exchange itself
+# (those have from_user_id = NULL). It only exists while the lab runs —
+# classusd.db itself is not changed.
+cur.executescript("""
+    CREATE TEMP TABLE user_names (user_id INTEGER PRIMARY KEY, handle TEXT NOT NULL);
+    INSERT INTO user_names VALUES (0, 'SYSTEM');
+    INSERT INTO user_names SELECT user_id, handle FROM users;
+""")
+
+# trades_named = the trades table with names filled in: from_user,
+# to_user and coin_symbol next to the IDs. It is exactly the 3-way JOIN
+# from Example 2A, saved once as a VIEW so later queries can just say
+# FROM trades_named instead of repeating it. Thanks to the SYSTEM row
+# above, every join is a plain JOIN. Like user_names, it only exists
+# while the lab runs.
+cur.executescript("""
+    CREATE TEMP VIEW IF NOT EXISTS trades_named AS
+        SELECT t.*,
+               sender.handle   AS from_user,
+               receiver.handle AS to_user,
+               c.symbol        AS coin_symbol
+        FROM   trades t
+        JOIN   user_names sender   ON IFNULL(t.from_user_id, 0) = sender.user_id
+        JOIN   users      receiver ON t.to_user_id              = receiver.user_id
+        JOIN   coins      c        ON t.coin_id                 = c.coin_id;
+""")
+
+# Per-coin trade totals, split by trade type. Sections 3 and 4 all need
+# counts and sums of trades per coin — working them out once here means
+# the trades table is read one time instead of once per query.
+cur.executescript("""
+    CREATE TEMP TABLE coin_agg AS
+        SELECT coin_id,
+               trade_type,
+               COUNT(*)           AS n,
+               SUM(amount)        AS vol,
+               SUM(burned_amount) AS burned
+        FROM trades
+        GROUP BY coin_id, trade_type;
+""")
+
+# Look up YOUR user_id and coin_id once, so the queries below can filter
+# on a plain number instead of searching by name every time.
+# (None means the username/coin isn't in this copy of the database yet.)
+row = cur.execute("SELECT user_id FROM users WHERE handle = ?", (MY_USERNAME,)).fetchone()
+MY_USER_ID = row[0] if row else None
+row = cur.execute("SELECT coin_id FROM coins WHERE symbol = ?", (MY_COIN,)).fetchone()
+MY_COIN_ID = row[0] if row else None
+row = cur.execute("SELECT coin_id FROM coins WHERE symbol = 'CLASSUSD'").fetchone()
+CLASSUSD_COIN_ID = row[0] if row else None
+
+# Run every query below inside ONE transaction, so they all read the same
+# snapshot of the database instead of setting up a fresh one per query.
+cur.execute("BEGIN")
+
+sys.stdout.write("=" * 55 + "\n"
+                 "  CLASSUSD SQL Lab\n"
+                 f"  Student: {MY_USERNAME}  |  Coin: {MY_COIN}\n"
+                 + "=" * 55 + "\n")
+
+
+# ── HELPER FUNCTIONS ────────────────────────────────────
+# These print query results as a neat table.
+# You don't need to change these — just call run_query()
+#
+# Output is collected into a list of lines and written in one go —
+# printing line by line is much slower, especially on Windows terminals.
 
+def print_section(title):
+    """Prints a section banner."""
+    sys.stdout.write("\n\n╔" + "═" * 54 + "╗\n"
+                     "║  " + title.ljust(51) + "║\n"
+                     "╚" + "═" * 54 + "╝\n")
 
-# ── HELPER FUNCTION ─────────────────────────────────────
-# This prints any query result as a neat table.
-# You don't need to change this — just call run_query()
 
-def run_query(label, sql, params=()):
+def run_query(label, sql, params=(), col_widths=None):
     """
     Runs a SQL query and prints the results as a table.
     
     Args:
-        label  — a title string for this query
-        sql    — your SQL query as a string
-        params — optional tuple of values to safely insert into the query
-    """
-    print(f"\n{'─' * 55}")
-    print(f"  {label}")
-    print(f"{'─' * 55}")
+        label      — a title string for this query
+        sql        — your SQL query as a string
+        params     — optional tuple of values to safely insert into the query
+        col_widths — optional list of column widths. When the widths are
+                     known in advance, rows are printed as they arrive
+                     instead of all being loaded into memory first.
+                     A longer value is still printed in full, it just
+                     pushes the rest of its row over. If the query returns
+                     a different number of columns, the widths are ignored.
+    """
+    lines = ["", "─" * 55, f"  {label}", "─" * 55]
     
     try:
         cur.execute(sql, params)
-        rows = cur.fetchall()
-        
+        headers = [d[0] for d in cur.description]
+
+        if col_widths is None or len(col_widths) != len(headers):
+            rows = cur.fetchall()
+            # Turn every cell into text once, then size each column to fit.
+            # Cells are read by position — looking them up by name means
+            # searching the column list again for every single cell.
+            str_rows = [tuple(str(v or "") for v in r) for r in rows]
+            widths   = [max(len(h), max((len(sr[i]) for sr in str_rows), default=0))
+                        for i, h in enumerate(headers)]
+        else:
+            rows = cur.fetchmany(1)
+            str_rows = None
+            widths   = [max(len(h), w) for h, w in zip(headers, col_widths)]
+
         if not rows:
-            print("  (no results — check your username/coin or run more trades)")
+            lines.append("  (no results — check your username/coin or run more trades)")
             return
+
+        fmt = "  " + "  ".join("{:<" + str(w) + "}" for w in widths)
+
+        # Column headers
+        header_line = fmt.format(*headers)
+        lines.append(header_line)
+        lines.append("  " + "-" * (len(header_line) - 2))
+
+        # One line per row
+        if str_rows is not None:
+            lines.extend(fmt.format(*sr) for sr in str_rows)
+            count = len(rows)
+        else:
+            # Streaming: write out each batch of rows as soon as it's ready
+            count = 0
+            cur.arraysize = 200
+            while rows:
+                lines.extend(fmt.format(*(str(v or "") for v in r)) for r in rows)
+                sys.stdout.write("\n".join(lines) + "\n")
+                lines = []
+                count += len(rows)
+                rows = cur.fetchmany()
         
-        # Print column headers
-        headers = rows[0].keys()
-        col_widths = {h: max(len(str(h)), max(len(str(r[h] or "")) for r in rows)) for h in headers}
-        
-        header_line = "  " + "  ".join(str(h).ljust(col_widths[h]) for h in headers)
-        print(header_line)
-        print("  " + "-" * (len(header_line) - 2))
-        
-        # Print each row
-        for row in rows:
-            print("  " + "  ".join(str(row[h] or "").ljust(col_widths[h]) for h in headers))
-        
-        print(f"\n  ({len(rows)} row{'s' if len(rows) != 1 else ''} returned)")
+        lines.append(f"\n  ({count} row{'s' if count != 1 else ''} returned)")
         
     except sqlite3.Error as e:
-        print(f"  SQL ERROR: {e}")
-        print(f"  Check your query for typos.")
+        lines.append(f"  SQL ERROR: {e}")
+        lines.append(f"  Check your query for typos.")
+
+    finally:
+        sys.stdout.write("\n".join(lines) + "\n")
 
 
 # ═══════════════════════════════════════════════════════════
@@ -100,9 +249,7 @@ def run_query(label, sql, params=()):
 #  WHERE  = like an if-statement filter on every row
 # ═══════════════════════════════════════════════════════════
 
-print("\n\n╔══════════════════════════════════════════════════════╗")
-print("║  SECTION 1 — Exploring the Database                 ║")
-print("╚══════════════════════════════════════════════════════╝")
+print_section("SECTION 1 — Exploring the Database")
 
 
 # ── WORKED EXAMPLE 1A ───────────────────────────────────
@@ -151,11 +298,13 @@ run_query(
 #                       amount, burned_amount, trade_type, executed_at
 #
 # You need to find trades where to_user_id matches YOUR user_id.
-# But you don't know your user_id number — use a subquery:
+# The setup code already looked your number up for you — it ran
+#   SELECT user_id FROM users WHERE handle = ?
+# once and stored the answer in MY_USER_ID. So the filter is just:
 #
-#   WHERE to_user_id = (SELECT user_id FROM users WHERE handle = ?)
+#   WHERE to_user_id = ?
 #
-# The ? is a safe placeholder — we pass MY_USERNAME as the value.
+# The ? is a safe placeholder — we pass MY_USER_ID as the value.
 # This is like a method parameter in Java — never put usernames
 # directly in the SQL string (that's called SQL injection!).
 
@@ -170,10 +319,10 @@ run_query(
         trade_type,
         executed_at
     FROM trades
-    WHERE to_user_id = (SELECT user_id FROM users WHERE handle = ?)
+    WHERE to_user_id = ?
     ORDER BY executed_at DESC
     """,
-    (MY_USERNAME,)   # ← this is how you pass the ? value safely
+    (MY_USER_ID,)   # ← this is how you pass the ? value safely
 )
 
 
@@ -190,23 +339,25 @@ run_query(
 #  In SQL you JOIN:   JOIN users sender ON trade.from_user_id = sender.user_id
 # ═══════════════════════════════════════════════════════════
 
-print("\n\n╔══════════════════════════════════════════════════════╗")
-print("║  SECTION 2 — JOIN: Combining Tables                 ║")
-print("╚══════════════════════════════════════════════════════╝")
+print_section("SECTION 2 — JOIN: Combining Tables")
 
 
 # ── WORKED EXAMPLE 2A ───────────────────────────────────
 # This JOIN makes trades human-readable by replacing IDs with names.
 # Notice: we JOIN users TWICE — once for sender, once for receiver.
 # We give each one an alias (sender / receiver) to tell them apart.
-# LEFT JOIN for sender = keep the row even if sender is NULL (SYSTEM trades)
+# SYSTEM trades have no sender (from_user_id is NULL). IFNULL(..., 0)
+# turns that NULL into 0, which matches the 'SYSTEM' row in user_names,
+# so a plain JOIN finds a name for every trade.
+# This same JOIN is saved as the trades_named view, which Section 5
+# uses so it doesn't have to be written out again.
 
 run_query(
     "EXAMPLE 2A: Trade history with real names",
     """
     SELECT
         t.trade_id,
-        COALESCE(sender.handle, 'SYSTEM')  AS from_user,
+        sender.handle                       AS from_user,
         receiver.handle                     AS to_user,
         c.symbol                            AS coin,
         t.amount,
@@ -214,9 +365,9 @@ run_query(
         t.trade_type,
         t.executed_at
     FROM   trades t
-    LEFT JOIN users sender   ON t.from_user_id = sender.user_id
-    JOIN      users receiver ON t.to_user_id   = receiver.user_id
-    JOIN      coins c        ON t.coin_id       = c.coin_id
+    JOIN   user_names sender   ON IFNULL(t.from_user_id, 0) = sender.user_id
+    JOIN   users      receiver ON t.to_user_id              = receiver.user_id
+    JOIN   coins      c        ON t.coin_id                 = c.coin_id
     ORDER BY t.executed_at DESC
     LIMIT 10
     """
@@ -250,14 +401,15 @@ run_query(
 
 # ── TASK 2C — JOIN filtered to YOUR coin ─────────────────
 # Copy your query from 2B but add a WHERE clause to only show
-# balances for YOUR coin (use MY_COIN and a ? placeholder)
+# balances for YOUR coin. Filter on the number, not the symbol:
+#   WHERE b.coin_id = ?      (MY_COIN_ID is passed as the ? value)
 
 run_query(
     "TASK 2C: Who holds YOUR coin? (YOUR QUERY HERE)",
     """
     ???
     """,
-    (MY_COIN,)   # pass MY_COIN as the ? value
+    (MY_COIN_ID,)   # pass MY_COIN_ID as the ? value
 )
 
 
@@ -275,14 +427,17 @@ run_query(
 #    MIN(col) — smallest value
 # ═══════════════════════════════════════════════════════════
 
-print("\n\n╔══════════════════════════════════════════════════════╗")
-print("║  SECTION 3 — GROUP BY: Aggregating Data             ║")
-print("╚══════════════════════════════════════════════════════╝")
+print_section("SECTION 3 — GROUP BY: Aggregating Data")
 
 
 # ── WORKED EXAMPLE 3A ───────────────────────────────────
 # Trading volume per coin — groups all trades by coin,
 # then counts and sums within each group.
+#
+# The setup code already counted the trades once into coin_agg
+# (one row per coin per trade_type, with n = count, vol = total amount,
+# burned = total burned). So here we just add up those small totals.
+# Average = total volume ÷ number of trades.
 
 run_query(
     "EXAMPLE 3A: Trading volume per coin",
@@ -290,13 +445,13 @@ run_query(
     SELECT
         c.symbol,
         c.name,
-        COUNT(t.trade_id)      AS trade_count,
-        SUM(t.amount)          AS total_volume,
-        SUM(t.burned_amount)   AS total_burned,
-        ROUND(AVG(t.amount),2) AS avg_trade_size
-    FROM   trades t
-    JOIN   coins c ON t.coin_id = c.coin_id
-    GROUP BY c.coin_id
+        SUM(a.n)                         AS trade_count,
+        SUM(a.vol)                       AS total_volume,
+        SUM(a.burned)                    AS total_burned,
+        ROUND(SUM(a.vol) / SUM(a.n), 2)  AS avg_trade_size
+    FROM   coin_agg a
+    JOIN   coins c ON a.coin_id = c.coin_id
+    GROUP BY a.coin_id
     ORDER BY total_volume DESC
     """
 )
@@ -304,20 +459,30 @@ run_query(
 
 # ── TASK 3B — Most active senders ────────────────────────
 # Write a GROUP BY query that shows, for each sender:
-#   - their handle (use COALESCE for SYSTEM trades)
+#   - their handle (SYSTEM trades already show up as 'SYSTEM')
 #   - how many trades they sent (COUNT)
 #   - total amount they sent (SUM)
 #   - average trade size (AVG, rounded to 2 decimal places)
 # Order by total amount sent, largest first.
+#
+# Tip: GROUP BY the sender's NUMBER (from_user_id), not their handle.
+# Comparing whole numbers is much faster than comparing text, so do
+# the counting in the inner query (agg) and only JOIN for the names
+# once at the end — one lookup per sender, not one per trade.
 
 run_query(
     "TASK 3B: Most active senders (YOUR QUERY HERE)",
     """
     SELECT
-        ???
-    FROM trades t
-    LEFT JOIN users sender ON t.from_user_id = sender.user_id
-    GROUP BY ???
+        ???                 -- sender.handle plus the columns from agg
+    FROM (
+        SELECT
+            from_user_id,
+            ???             -- COUNT, SUM and AVG go here
+        FROM trades
+        GROUP BY from_user_id
+    ) agg
+    JOIN user_names sender ON IFNULL(agg.from_user_id, 0) = sender.user_id
     ORDER BY ???
     """
 )
@@ -326,14 +491,15 @@ run_query(
 # ── TASK 3C — YOUR coin's stats ──────────────────────────
 # Write a query that shows stats for ONLY your coin:
 #   symbol, trade_count, total_volume, total_burned
-# Filter to just MY_COIN using WHERE before the GROUP BY.
+# Filter to just your coin using WHERE coin_id = ? before the GROUP BY.
+# Hint: you can start from coin_agg like Example 3A does.
 
 run_query(
     "TASK 3C: Stats for YOUR coin only (YOUR QUERY HERE)",
     """
     ???
     """,
-    (MY_COIN,)
+    (MY_COIN_ID,)
 )
 
 
@@ -351,9 +517,7 @@ run_query(
 #    HAVING = filter after you group  (like an if after the loop)
 # ═══════════════════════════════════════════════════════════
 
-print("\n\n╔══════════════════════════════════════════════════════╗")
-print("║  SECTION 4 — HAVING: Filtering Groups               ║")
-print("╚══════════════════════════════════════════════════════╝")
+print_section("SECTION 4 — HAVING: Filtering Groups")
 
 
 # ── WORKED EXAMPLE 4A ───────────────────────────────────
@@ -366,13 +530,13 @@ run_query(
     SELECT
         c.symbol,
         c.name,
-        COUNT(t.trade_id)  AS trade_count,
-        SUM(t.amount)      AS total_volume
-    FROM   trades t
-    JOIN   coins c ON t.coin_id = c.coin_id
-    WHERE  t.trade_type != 'welcome'
-    GROUP BY c.coin_id
-    HAVING COUNT(t.trade_id) > 2
+        SUM(a.n)    AS trade_count,
+        SUM(a.vol)  AS total_volume
+    FROM   coin_agg a
+    JOIN   coins c ON a.coin_id = c.coin_id
+    WHERE  a.trade_type != 'welcome'
+    GROUP BY a.coin_id
+    HAVING SUM(a.n) > 2
     ORDER BY trade_count DESC
     """
 )
@@ -383,17 +547,23 @@ run_query(
 # more than 2 transfers (not counting welcome bonuses).
 # Show: handle, number of transfers received.
 # Hint: GROUP BY the recipient (to_user_id), JOIN users for the handle.
+# Same trick as 3B: group by the number first, JOIN for names last.
 
 run_query(
     "TASK 4B: Students with more than 2 transfers received (YOUR QUERY HERE)",
     """
     SELECT
         ???
-    FROM trades t
+    FROM (
+        SELECT
+            to_user_id,
+            ???
+        FROM trades
+        WHERE trade_type != 'welcome'
+        GROUP BY to_user_id
+        HAVING ???
+    ) agg
     JOIN users receiver ON ???
-    WHERE t.trade_type != 'welcome'
-    GROUP BY ???
-    HAVING ???
     ORDER BY ???
     """
 )
@@ -422,47 +592,53 @@ run_query(
 #  The chain: block N's prev_hash must equal block N-1's this_hash
 # ═══════════════════════════════════════════════════════════
 
-print("\n\n╔══════════════════════════════════════════════════════╗")
-print("║  SECTION 5 — The Blockchain                         ║")
-print("╚══════════════════════════════════════════════════════╝")
+print_section("SECTION 5 — The Blockchain")
 
 
 # ── WORKED EXAMPLE 5A ───────────────────────────────────
-# Show the full blockchain for YOUR coin
+# Show the full blockchain for YOUR coin.
+# trades_named (set up at the top of the lab) already has the
+# sender and receiver names, so one JOIN is enough here.
 
-run_query(
-    "EXAMPLE 5A: Your coin's blockchain",
-    """
+EXAMPLE_5A_SQL = """
     SELECT
         lb.block_id,
-        SUBSTR(lb.prev_hash, 1, 16) || '...'  AS prev_hash,
-        SUBSTR(lb.this_hash, 1, 16) || '...'  AS this_hash,
-        COALESCE(sender.handle, 'SYSTEM')      AS from_user,
-        receiver.handle                         AS to_user,
+        printf('%.16s...', lb.prev_hash)       AS prev_hash,
+        printf('%.16s...', lb.this_hash)       AS this_hash,
+        t.from_user,
+        t.to_user,
         t.amount,
         t.trade_type
     FROM   ledger_blocks lb
-    JOIN   trades t     ON lb.trade_id = t.trade_id
-    JOIN   coins  c     ON lb.coin_id  = c.coin_id
-    LEFT JOIN users sender   ON t.from_user_id = sender.user_id
-    JOIN      users receiver ON t.to_user_id   = receiver.user_id
-    WHERE  c.symbol = ?
+    JOIN   trades_named t ON lb.trade_id = t.trade_id
+    WHERE  lb.coin_id = ?
     ORDER BY lb.block_id ASC
-    """,
-    (MY_COIN,)
-)
+"""
+
+# printf('%.16s...', hash) keeps the first 16 characters and adds '...'
+# in one step, so the hash columns are always 19 characters wide. Every
+# column's width is known before the query runs, and the chain can be
+# printed as it streams. The amount column is wide enough for the biggest
+# balances on the exchange, so the numbers line up too.
+CHAIN_COL_WIDTHS = [8, 19, 19, 20, 20, 18, 12]
+
+run_query("EXAMPLE 5A: Your coin's blockchain", EXAMPLE_5A_SQL, (MY_COIN_ID,),
+          col_widths=CHAIN_COL_WIDTHS)
 
 
 # ── TASK 5B — YOUR QUERY: Chain for CLASSUSD ────────────
 # Copy the query from 5A but change it to show the CLASSUSD
 # blockchain instead of your coin.
-# Change the WHERE clause — use 'CLASSUSD' directly (no ?).
+# Only the ? value changes — the setup code looked up CLASSUSD's
+# coin_id for you and stored it in CLASSUSD_COIN_ID.
 
 run_query(
     "TASK 5B: CLASSUSD blockchain (YOUR QUERY HERE)",
     """
     ???
-    """
+    """,
+    (CLASSUSD_COIN_ID,),
+    col_widths=CHAIN_COL_WIDTHS
 )
 
 
@@ -471,22 +647,37 @@ run_query(
 # We want to find any block where prev_hash does NOT match
 # the previous block's this_hash.
 #
-# We do this with a self-JOIN — joining ledger_blocks to itself:
-#   lb  = the current block
-#   lb2 = the previous block (block_id is one less)
+# We do this with a WINDOW FUNCTION. LAG(this_hash) looks back one
+# row and hands you the previous block's this_hash, in a single pass
+# over the table — no need to JOIN ledger_blocks to itself.
+#   PARTITION BY coin_id  = every coin has its own chain, so "previous"
+#                           means the previous block of the SAME coin
+#   ORDER BY block_id     = the order the blocks were added
+#
+# The WITH ... AS (...) part is a CTE — a named, temporary result you
+# can SELECT from, like a helper variable in Java.
+# The first block of each chain has no previous block, so actual_prev
+# is NULL there.
 #
 # Fill in the WHERE clause to find mismatches.
 
 run_query(
     "TASK 5C: Find broken chain links (YOUR QUERY HERE)",
     """
+    WITH chain AS (
+        SELECT
+            block_id,
+            prev_hash                          AS stored_prev,
+            LAG(this_hash) OVER (PARTITION BY coin_id
+                                 ORDER BY block_id) AS actual_prev
+        FROM ledger_blocks
+    )
     SELECT
-        lb.block_id         AS broken_block,
-        lb.prev_hash        AS stored_prev,
-        lb2.this_hash       AS actual_prev
-    FROM   ledger_blocks lb
-    JOIN   ledger_blocks lb2 ON lb2.block_id = lb.block_id - 1
-    WHERE  ???    -- hint: compare lb.prev_hash to lb2.this_hash
+        block_id        AS broken_block,
+        stored_prev,
+        actual_prev
+    FROM   chain
+    WHERE  ???    -- hint: compare stored_prev to actual_prev
     """
 )
 
@@ -494,6 +685,30 @@ run_query(
 # If it returns rows — those blocks are broken (tampered with).
 
 
+# ── CHECK YOUR 5C ANSWER ─────────────────────────────────
+# The same check written in Python: read every chain once, in order,
+# and compare each block's prev_hash with the this_hash we saw just
+# before it. Your 5C query should find exactly these blocks.
+
+def find_broken_links():
+    """Returns the block_ids whose prev_hash doesn't match the previous block of the same coin."""
+    broken = []
+    prev_coin, prev_hash = None, None
+    for block_id, coin_id, stored_prev, this_hash in cur.execute(
+            "SELECT block_id, coin_id, prev_hash, this_hash "
+            "FROM ledger_blocks ORDER BY coin_id, block_id"):
+        if coin_id == prev_coin and stored_prev != prev_hash:
+            broken.append(block_id)
+        prev_coin, prev_hash = coin_id, this_hash
+    return broken
+
+broken = find_broken_links()
+if broken:
+    sys.stdout.write(f"\n  Python check: {len(broken)} broken link(s) at block(s) {broken}\n")
+else:
+    sys.stdout.write("\n  Python check: 0 broken links — every chain is intact.\n")
+
+
 # ═══════════════════════════════════════════════════════════
 #  SECTION 6 — Your Coin's Story
 #
@@ -501,9 +716,7 @@ run_query(
 #  Write SQL that tells the story of YOUR coin using real data.
 # ═══════════════════════════════════════════════════════════
 
-print("\n\n╔══════════════════════════════════════════════════════╗")
-print("║  SECTION 6 — Your Coin's Story (No Template)        ║")
-print("╚══════════════════════════════════════════════════════╝")
+print_section("SECTION 6 — Your Coin's Story (No Template)")
 
 
 # ── TASK 6A — Prove your token rules work ────────────────
@@ -513,6 +726,8 @@ print("╚═══════════════════════
 #   Airdrop:  show trades where trade_type = 'airdrop'
 #   Staking:  show trades where trade_type = 'stake_reward'
 #   Anti-whale: show that no holder exceeds your max_holding
+# Tip: FROM trades_named gives you from_user, to_user and
+# coin_symbol without writing any JOINs yourself.
 
 run_query(
     "TASK 6A: Evidence that my token rule works",
@@ -542,7 +757,8 @@ run_query(
 
 
 # ── CLOSE CONNECTION ──────────────────────────────────────
+cur.execute("COMMIT")
 conn.close()
-print("\n" + "=" * 55)
-print("  Lab complete! Screenshot each section's output.")
-print("=" * 55)
+sys.stdout.write("\n" + "=" * 55 + "\n"
+                 "  Lab complete! Screenshot each section's output.\n"
+                 + "=" * 55 + "\n")
@@ -12,38 +12,139 @@ Features:
 
 import sqlite3
 import hashlib
+import hmac
 import csv
+import gzip
 import io
+import itertools
 import os
 import json
+import queue
+import tempfile
+import threading
+import time
 from datetime import datetime, timezone
-from flask import Flask, request, jsonify, send_file, send_from_directory, g
+from functools import lru_cache, wraps
+from flask import Flask, Response, request, jsonify, send_file, g, stream_with_context
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson          # optional: `pip install orjson` for faster JSON
+except ImportError:
+    orjson = None
+
+
+class ExchangeJSONProvider(DefaultJSONProvider):
+    """
+    jsonify() that understands sqlite3.Row, so endpoints can return query
+    rows directly instead of copying each one into a dict first. Keys stay
+    in column order rather than being sorted. Uses orjson when installed.
+    """
+    sort_keys = False
+
+    @staticmethod
+    def default(o):
+        if isinstance(o, sqlite3.Row):
+            return dict(o)
+        return DefaultJSONProvider.default(o)
+
+    @staticmethod
+    def _unrow(obj):
+        # A list of rows from one query all share the same columns, so the
+        # names are read once and zipped against each row's values. That is
+        # cheaper than dict(row), which looks every column up by name.
+        if type(obj) is list and obj and type(obj[0]) is sqlite3.Row:
+            keys = obj[0].keys()
+            return [dict(zip(keys, r)) for r in obj]
+        return obj
+
+    def dumps(self, obj, **kwargs):
+        unrow = self._unrow
+        obj = ({k: unrow(v) for k, v in obj.items()} if type(obj) is dict
+               else unrow(obj))
+        if orjson is not None:
+            return orjson.dumps(obj, default=self.default).decode()
+        return super().dumps(obj, **kwargs)
+
 
 app = Flask(__name__, static_folder='public')
+app.json = ExchangeJSONProvider(app)
 
 DB_PATH          = 'classusd.db'
 TEACHER_KEY = os.environ.get('CLASSUSD_TEACHER_KEY','')
 RESERVE_CURRENCY = 'CLASSUSD'   # the base currency everyone starts with
 STARTING_BALANCE = 100.0        # how much CLASSUSD each student gets on signup
 STAKING_RATE     = 0.02         # 2% per manual claim (teacher can adjust)
+SCRYPT_N, SCRYPT_R, SCRYPT_P = 2**14, 8, 1   # password hashing cost
+DB_POOL_SIZE     = (os.cpu_count() or 2) * 2  # idle connections kept open
+PRICE_MATCH_WINDOW = 60         # seconds apart a coin + CLASSUSD pair can be
+READ_CACHE_TTL   = 2.0          # seconds a polled read endpoint's answer is reused
+WRITE_BATCH_MAX  = 100          # most sends committed together by the writer
+WRITE_BATCH_WAIT = 0.005        # seconds the writer waits for a batch to fill
+WRITE_TIMEOUT    = 10.0         # seconds a send waits for the writer to answer
+LEDGER_PAGE_MAX  = 1000         # most trades one ?limit= page of /api/ledger returns
 
 
 # ─────────────────────────────────────────
 #  DATABASE
 # ─────────────────────────────────────────
 
+# Connections are kept open between requests and reused, so SQLite's page
+# cache stays warm instead of starting cold on every request. Each request
+# checks one out for itself, so no two threads ever share a connection.
+_pool = queue.Queue(maxsize=DB_POOL_SIZE)
+
+# isolation_level=None leaves transactions to us: every write endpoint opens
+# one with BEGIN IMMEDIATE, which takes the write lock up front instead of
+# upgrading a read lock halfway through (the upgrade is what fails with
+# "database is locked" when two students write at once).
+def _connect():
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False, cached_statements=512,
+                           isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.executescript("""
+        PRAGMA journal_mode=WAL;
+        PRAGMA foreign_keys=ON;
+        -- With WAL, NORMAL only syncs at checkpoints instead of on every
+        -- commit, and a crash still can't corrupt the database.
+        PRAGMA synchronous=NORMAL;
+        PRAGMA busy_timeout=5000;
+        PRAGMA temp_store=MEMORY;
+        PRAGMA cache_size=-64000;
+        PRAGMA mmap_size=268435456;
+        PRAGMA wal_autocheckpoint=1000;
+    """)
+    return conn
+
 def get_db():
     if 'db' not in g:
-        g.db = sqlite3.connect(DB_PATH)
-        g.db.row_factory = sqlite3.Row
-        g.db.execute("PRAGMA journal_mode=WAL")
-        g.db.execute("PRAGMA foreign_keys=ON")
+        try:
+            g.db = _pool.get_nowait()
+        except queue.Empty:
+            g.db = _connect()
+        g._tip_hash_cache = {}   # coin_id -> this_hash of the newest block
     return g.db
 
 @app.teardown_appcontext
 def close_db(e=None):
     db = g.pop('db', None)
-    if db: db.close()
+    if db is None:
+        return
+    # A request that returned early (e.g. an error) may have left writes
+    # uncommitted — never hand those on to the next request.
+    if db.in_transaction:
+        db.rollback()
+    try:
+        _pool.put_nowait(db)
+    except queue.Full:
+        db.close()
+
+@app.after_request
+def clear_caches_after_write(response):
+    # Every POST endpoint changes data, so cached reads are dropped after one
+    if request.method == 'POST':
+        clear_read_caches()
+    return response
 
 def init_db():
     conn = sqlite3.connect(DB_PATH)
@@ -97,7 +198,8 @@ def init_db():
             trade_type    TEXT    NOT NULL DEFAULT 'transfer',
                 -- values: 'transfer', 'airdrop', 'stake_reward', 'welcome'
             note          TEXT,
-            executed_at   TEXT    NOT NULL DEFAULT (datetime('now'))
+            executed_at   TEXT    NOT NULL DEFAULT (datetime('now')),
+            executed_at_epoch INTEGER   -- executed_at as Unix seconds, for time math
         );
 
         -- ── BLOCKCHAIN ─────────────────────────────────────────────
@@ -121,6 +223,77 @@ def init_db():
             updated_at  TEXT    NOT NULL DEFAULT (datetime('now'))
         );
 
+        -- ── IMPLIED PRICES ─────────────────────────────────────────
+        -- Totals from matched coin/CLASSUSD transfer pairs, one row per
+        -- coin that has any. Rebuilt by refresh_implied_prices().
+        CREATE TABLE IF NOT EXISTS implied_prices (
+            coin_id     INTEGER PRIMARY KEY REFERENCES coins(coin_id),
+            sum_coin    REAL    NOT NULL,
+            sum_cash    REAL    NOT NULL,
+            matches     INTEGER NOT NULL,
+            updated_at  TEXT
+        );
+
+        -- ── CHAIN VERIFY STATE ─────────────────────────────────────
+        -- Newest block /api/chain has checked per coin, so the next call
+        -- only rehashes blocks added since. Removed if a check fails, and
+        -- by the triggers below whenever an already-written block or the
+        -- trade it hashes is edited or deleted (e.g. in DB Browser for the
+        -- tamper demo), so the next check starts again from genesis.
+        CREATE TABLE IF NOT EXISTS chain_verify_state (
+            coin_id       INTEGER PRIMARY KEY REFERENCES coins(coin_id),
+            last_block_id INTEGER NOT NULL,
+            last_hash     TEXT    NOT NULL,
+            checked_at    TEXT    NOT NULL
+        );
+
+        CREATE TRIGGER IF NOT EXISTS trg_trades_edit_unverify
+        AFTER UPDATE OF trade_id, from_user_id, to_user_id, coin_id, amount, executed_at ON trades
+        BEGIN
+            DELETE FROM chain_verify_state WHERE coin_id IN (OLD.coin_id, NEW.coin_id);
+        END;
+        CREATE TRIGGER IF NOT EXISTS trg_trades_delete_unverify
+        AFTER DELETE ON trades
+        BEGIN
+            DELETE FROM chain_verify_state WHERE coin_id = OLD.coin_id;
+        END;
+        CREATE TRIGGER IF NOT EXISTS trg_lb_edit_unverify
+        AFTER UPDATE ON ledger_blocks
+        BEGIN
+            DELETE FROM chain_verify_state WHERE coin_id IN (OLD.coin_id, NEW.coin_id);
+        END;
+        CREATE TRIGGER IF NOT EXISTS trg_lb_delete_unverify
+        AFTER DELETE ON ledger_blocks
+        BEGIN
+            DELETE FROM chain_verify_state WHERE coin_id = OLD.coin_id;
+        END;
+        -- A block slipped in below the verified tip would otherwise be skipped
+        CREATE TRIGGER IF NOT EXISTS trg_lb_insert_unverify
+        AFTER INSERT ON ledger_blocks
+        WHEN NEW.block_id <= (SELECT last_block_id FROM chain_verify_state
+                              WHERE coin_id = NEW.coin_id)
+        BEGIN
+            DELETE FROM chain_verify_state WHERE coin_id = NEW.coin_id;
+        END;
+
+        -- ── INDEXES ────────────────────────────────────────────────
+        -- lab.py uses the same names and columns for the ones it also
+        -- needs (it adds idx_trades_time, and skips idx_coins_creator), so
+        -- a database used by both never holds two copies of one index.
+        -- balances(user_id) is already covered by UNIQUE(user_id, coin_id).
+        CREATE INDEX IF NOT EXISTS idx_balances_coin    ON balances(coin_id, amount DESC);
+        CREATE INDEX IF NOT EXISTS idx_trades_from_time ON trades(from_user_id, executed_at DESC);
+        CREATE INDEX IF NOT EXISTS idx_trades_to_time   ON trades(to_user_id, executed_at DESC);
+        -- coin_id plus the implied trade_id: /api/ledger?symbol= reads one
+        -- coin's trades already in trade_id order, with no sort.
+        CREATE INDEX IF NOT EXISTS idx_trades_coin      ON trades(coin_id);
+        -- Covering: a coin's chain is read from the index alone
+        DROP INDEX IF EXISTS idx_lb_coin_block;
+        CREATE INDEX IF NOT EXISTS idx_lb_chain         ON ledger_blocks(coin_id, block_id,
+                                                           prev_hash, this_hash, trade_id);
+        CREATE INDEX IF NOT EXISTS idx_lb_trade         ON ledger_blocks(trade_id);
+        CREATE INDEX IF NOT EXISTS idx_coins_creator    ON coins(creator_id);
+
         -- ── VIEWS ──────────────────────────────────────────────────
         DROP VIEW IF EXISTS trade_history;
         CREATE VIEW trade_history AS
@@ -156,6 +329,20 @@ def init_db():
             ORDER BY c.symbol, b.amount DESC;
     """)
 
+    # Databases made before executed_at_epoch existed: add it and fill it in
+    trade_cols = [r[1] for r in conn.execute("PRAGMA table_info(trades)")]
+    if 'executed_at_epoch' not in trade_cols:
+        conn.execute("ALTER TABLE trades ADD COLUMN executed_at_epoch INTEGER")
+        conn.execute("UPDATE trades SET executed_at_epoch = CAST(strftime('%s', executed_at) AS INTEGER)")
+    # Partial index over just the trades the price matcher pairs up, so it
+    # stays small and both sides of its join are range scans on it.
+    conn.executescript("""
+        DROP INDEX IF EXISTS idx_trades_epoch_type;
+        CREATE INDEX IF NOT EXISTS idx_trades_reserve_epoch
+            ON trades(coin_id, executed_at_epoch) WHERE trade_type = 'TRANSFER';
+    """)
+    conn.commit()
+
     # Seed the reserve currency
     conn.execute("""
         INSERT OR IGNORE INTO coins
@@ -171,6 +358,16 @@ def init_db():
         FROM coins
     """, (RESERVE_CURRENCY,))
     conn.commit()
+
+    # Fill implied_prices for databases that didn't have it yet
+    conn.row_factory = sqlite3.Row
+    refresh_implied_prices(conn)
+    conn.commit()
+
+    # Table statistics so the planner knows which index to pick
+    if not conn.execute("SELECT 1 FROM sqlite_master WHERE name='sqlite_stat1'").fetchone():
+        conn.execute("ANALYZE")
+    conn.execute("PRAGMA optimize")
     conn.close()
     print("✅ Database ready.")
 
@@ -180,98 +377,316 @@ def init_db():
 # ─────────────────────────────────────────
 
 def hash_password(pw):
-    return hashlib.sha256(pw.encode()).hexdigest()
+    """Salted scrypt hash, stored as 'scrypt$<salt hex>$<hash hex>'."""
+    salt = os.urandom(16)
+    key  = hashlib.scrypt(pw.encode(), salt=salt, n=SCRYPT_N, r=SCRYPT_R, p=SCRYPT_P)
+    return f"scrypt${salt.hex()}${key.hex()}"
+
+@lru_cache(maxsize=1024)
+def verify_password(pw, stored):
+    """
+    Checks pw against a stored hash. Accounts created before scrypt have a
+    plain sha256 hex digest, which still works. Results are cached per
+    (password, stored hash), so a student sending several trades in a row
+    only pays for scrypt once — changing the stored hash misses the cache.
+    """
+    if stored.startswith('scrypt$'):
+        _, salt, expected = stored.split('$')
+        actual = hashlib.scrypt(pw.encode(), salt=bytes.fromhex(salt),
+                                n=SCRYPT_N, r=SCRYPT_R, p=SCRYPT_P).hex()
+    else:
+        expected = stored
+        actual   = hashlib.sha256(pw.encode()).hexdigest()
+    return hmac.compare_digest(actual, expected)
 
 def now_iso():
     return datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S')
 
+def now_stamp():
+    """Current time as (iso string, Unix seconds) — both the same instant."""
+    now = datetime.now(timezone.utc)
+    return now.strftime('%Y-%m-%dT%H:%M:%S'), int(now.timestamp())
+
+_sha256 = hashlib.sha256
+
 def compute_block_hash(prev_hash, trade_id, from_user_id, to_user_id, coin_id, amount, executed_at):
-    data = f"{prev_hash}|{trade_id}|{from_user_id}|{to_user_id}|{coin_id}|{amount}|{executed_at}"
-    return hashlib.sha256(data.encode()).hexdigest()
+    # The exact text hashed here is what student/verify_chain.py recomputes,
+    # so the format can't change. One f-string and one hash call is already
+    # the least work per block; the only saving is skipping the hashlib lookup.
+    return _sha256(
+        f"{prev_hash}|{trade_id}|{from_user_id}|{to_user_id}|{coin_id}|{amount}|{executed_at}".encode()
+    ).hexdigest()
+
+_ttl_caches = []
+
+def ttl_cache(seconds):
+    """
+    Remembers a function's result per argument tuple for `seconds`.
+    Every open browser polls the same read endpoints, so within a couple of
+    seconds they can all share one answer. Any POST clears these caches
+    (see clear_caches_after_write), so a write shows up straight away.
+    When an entry expires only one thread recomputes it; the others asking
+    for the same arguments wait for that answer instead of all running the
+    same query at once. Each argument tuple has its own fill lock, so a slow
+    query for one key never holds up misses on another. Callers should only
+    pass arguments from a small known set (ids, not raw query strings).
+    """
+    def wrap(fn):
+        cache = {}
+        lock  = threading.Lock()
+        fills = {}      # args -> lock held while that entry is recomputed
+
+        def fresh(args):
+            with lock:
+                hit = cache.get(args)
+            if hit and time.monotonic() - hit[0] < seconds:
+                return hit
+            return None
+
+        @wraps(fn)
+        def cached(*args):
+            hit = fresh(args)
+            if hit:
+                return hit[1]
+            with lock:
+                fill = fills.get(args)
+                if fill is None:
+                    fill = fills[args] = threading.Lock()
+            with fill:
+                try:
+                    hit = fresh(args)   # another thread may have just filled it
+                    if hit:
+                        return hit[1]
+                    now   = time.monotonic()
+                    value = fn(*args)
+                    with lock:
+                        cache[args] = (now, value)
+                finally:
+                    # Threads already waiting keep their reference; later
+                    # ones find the stored value, so the lock can go.
+                    with lock:
+                        if fills.get(args) is fill:
+                            del fills[args]
+            return value
+
+        def cache_clear():
+            with lock:
+                cache.clear()
+                fills.clear()
+
+        cached.cache_clear = cache_clear
+        _ttl_caches.append(cached)
+        return cached
+    return wrap
+
+def clear_read_caches():
+    for cached in _ttl_caches:
+        cached.cache_clear()
+
+# Hot statements live in one place so every call passes the very same
+# string to execute() and hits the connection's compiled-statement cache.
+SQL_USER_AUTH   = "SELECT user_id, password_hash FROM users WHERE handle=?"
+SQL_USER_ID     = "SELECT user_id FROM users WHERE handle=?"
+SQL_COIN_ID     = "SELECT coin_id FROM coins WHERE symbol=?"
+SQL_GET_BALANCE = "SELECT amount, staked FROM balances WHERE user_id=? AND coin_id=?"
+SQL_PREV_HASH   = "SELECT this_hash FROM ledger_blocks WHERE coin_id=? ORDER BY block_id DESC LIMIT 1"
+SQL_CHAIN_STATE = "SELECT last_block_id, last_hash FROM chain_verify_state WHERE coin_id=?"
+
+SQL_CHAIN_BLOCKS = """
+    SELECT lb.*, COALESCE(s.handle,'SYSTEM') AS from_user, r.handle AS to_user,
+           t.from_user_id, t.to_user_id,
+           t.amount, t.trade_type, t.executed_at AS trade_time
+    FROM ledger_blocks lb
+    JOIN  trades t ON lb.trade_id = t.trade_id
+    LEFT JOIN users s ON t.from_user_id = s.user_id
+    JOIN  users r ON t.to_user_id = r.user_id
+    WHERE lb.coin_id=?
+    ORDER BY lb.block_id ASC
+"""
+
+SQL_SAVE_CHAIN_STATE = """
+    INSERT INTO chain_verify_state (coin_id, last_block_id, last_hash, checked_at)
+    VALUES (?, ?, ?, ?)
+    ON CONFLICT(coin_id) DO UPDATE SET
+        last_block_id=excluded.last_block_id, last_hash=excluded.last_hash,
+        checked_at=excluded.checked_at
+    WHERE excluded.last_block_id >= chain_verify_state.last_block_id
+"""
+
+SQL_EXPORT_CSV = """
+    SELECT t.trade_id, COALESCE(s.handle,'SYSTEM') AS from_user,
+           r.handle AS to_user, c.symbol, t.amount, t.burned_amount,
+           t.trade_type, t.note, t.executed_at, lb.prev_hash, lb.this_hash
+    FROM trades t
+    LEFT JOIN users s ON t.from_user_id = s.user_id
+    JOIN  users r ON t.to_user_id = r.user_id
+    JOIN  coins c ON t.coin_id = c.coin_id
+    LEFT JOIN ledger_blocks lb ON lb.trade_id = t.trade_id
+    ORDER BY t.trade_id
+"""
+
+# Handles and symbols never change or get deleted, so once an id is found
+# it's kept for the life of the process. Misses aren't cached — the user
+# or coin may be created a moment later.
+_user_ids = {}
+_coin_ids = {}
+
+def lookup_user_id(db, handle):
+    uid = _user_ids.get(handle)
+    if uid is None:
+        r = db.execute(SQL_USER_ID, (handle,)).fetchone()
+        if r:
+            uid = _user_ids[handle] = r['user_id']
+    return uid
+
+def lookup_coin_id(db, symbol):
+    cid = _coin_ids.get(symbol)
+    if cid is None:
+        r = db.execute(SQL_COIN_ID, (symbol,)).fetchone()
+        if r:
+            cid = _coin_ids[symbol] = r['coin_id']
+    return cid
 
 def get_reserve_id(db):
-    r = db.execute("SELECT coin_id FROM coins WHERE symbol=?", (RESERVE_CURRENCY,)).fetchone()
-    return r['coin_id']
+    return lookup_coin_id(db, RESERVE_CURRENCY)
+
+
+# Coin transfer paired with a CLASSUSD transfer between the same two users
+# (either direction) within :window seconds. Time math uses the integer
+# executed_at_epoch column, so the reserve side is an index range scan and
+# no timestamps are parsed per pair.
+_PRICE_PAIRS = """
+    FROM trades ct
+    JOIN trades rt ON rt.coin_id = :reserve
+    WHERE ct.trade_type = 'TRANSFER'
+      AND rt.trade_type = 'TRANSFER'
+      AND ct.coin_id != :reserve
+      AND ct.from_user_id IS NOT NULL
+      AND ct.to_user_id   IS NOT NULL
+      AND rt.from_user_id IS NOT NULL
+      AND rt.to_user_id   IS NOT NULL
+      AND (
+            (ct.from_user_id = rt.from_user_id AND ct.to_user_id = rt.to_user_id)
+         OR (ct.from_user_id = rt.to_user_id   AND ct.to_user_id = rt.from_user_id)
+      )
+      AND rt.executed_at_epoch BETWEEN ct.executed_at_epoch - :window
+                                   AND ct.executed_at_epoch + :window
+"""
 
+SQL_PRICE_CANDIDATES = """
+    SELECT
+        ct.trade_id  AS coin_trade_id,
+        rt.trade_id  AS cash_trade_id,
+        ct.coin_id   AS coin_id,
+        ct.amount    AS coin_amount,
+        rt.amount    AS cash_amount,
+        CASE
+            WHEN ct.executed_at >= rt.executed_at THEN ct.executed_at
+            ELSE rt.executed_at
+        END AS matched_at
+""" + _PRICE_PAIRS + """
+      {coin_filter}
+    ORDER BY ABS(ct.executed_at_epoch - rt.executed_at_epoch) ASC,
+             ct.trade_id DESC, rt.trade_id DESC
+"""
+SQL_PRICE_CANDIDATES_ALL  = SQL_PRICE_CANDIDATES.format(coin_filter="")
+SQL_PRICE_CANDIDATES_SOME = SQL_PRICE_CANDIDATES.format(
+    coin_filter="AND ct.coin_id IN (SELECT value FROM json_each(:coins))")
+
+# Other coins whose trades could claim one of the given cash trades
+SQL_PRICE_LINKED_COINS = """
+    SELECT DISTINCT ct.coin_id
+""" + _PRICE_PAIRS + """
+      AND rt.trade_id IN (SELECT value FROM json_each(:cash))
+      AND ct.coin_id NOT IN (SELECT value FROM json_each(:coins))
+"""
 
-def get_implied_prices(db, window_seconds=60):
+def refresh_implied_prices(db, window_seconds=PRICE_MATCH_WINDOW, coin_ids=None):
     """
     Estimate coin prices in CLASSUSD from matched transfer pairs:
     - one non-CLASSUSD transfer
     - one CLASSUSD transfer
     - same two users (either direction)
     - executed within `window_seconds`
+    and store each coin's totals in implied_prices. Runs when a transfer is
+    written (and once at startup), so reading prices never redoes the
+    matching.
+
+    `coin_ids` limits the work to the coins just traded. A new trade can
+    change which earlier trades pair up, and each CLASSUSD trade pairs with
+    at most one coin trade of any coin, so the set grows to every coin that
+    competes for the same CLASSUSD trades before those rows are redone.
+    A CLASSUSD transfer can pair with any coin, so it rebuilds everything.
     """
     reserve_id = get_reserve_id(db)
+    params = {'reserve': reserve_id, 'window': int(window_seconds)}
+    if coin_ids is not None and reserve_id in coin_ids:
+        coin_ids = None
 
     # Potential matches (many-to-many). We'll greedily choose closest unique pairs.
-    candidates = db.execute("""
-        SELECT
-            ct.trade_id  AS coin_trade_id,
-            ct.coin_id   AS coin_id,
-            cc.symbol    AS symbol,
-            ct.amount    AS coin_amount,
-            rt.trade_id  AS cash_trade_id,
-            rt.amount    AS cash_amount,
-            ABS(strftime('%s', ct.executed_at) - strftime('%s', rt.executed_at)) AS time_gap_s,
-            CASE
-                WHEN ct.executed_at >= rt.executed_at THEN ct.executed_at
-                ELSE rt.executed_at
-            END AS matched_at
-        FROM trades ct
-        JOIN coins cc ON cc.coin_id = ct.coin_id
-        JOIN trades rt ON rt.coin_id = ?
-        WHERE ct.trade_type = 'TRANSFER'
-          AND rt.trade_type = 'TRANSFER'
-          AND ct.coin_id != ?
-          AND ct.from_user_id IS NOT NULL
-          AND ct.to_user_id   IS NOT NULL
-          AND rt.from_user_id IS NOT NULL
-          AND rt.to_user_id   IS NOT NULL
-          AND (
-                (ct.from_user_id = rt.from_user_id AND ct.to_user_id = rt.to_user_id)
-             OR (ct.from_user_id = rt.to_user_id   AND ct.to_user_id = rt.from_user_id)
-          )
-          AND ABS(strftime('%s', ct.executed_at) - strftime('%s', rt.executed_at)) <= ?
-        ORDER BY time_gap_s ASC, ct.trade_id DESC, rt.trade_id DESC
-    """, (reserve_id, reserve_id, int(window_seconds))).fetchall()
-
-    used_coin_trades = set()
-    used_cash_trades = set()
-    implied_by_coin = {}  # coin_id -> stats
-    for row in candidates:
-        coin_tid = row['coin_trade_id']
-        cash_tid = row['cash_trade_id']
-        if coin_tid in used_coin_trades or cash_tid in used_cash_trades:
+    # The greedy pick stays in Python: it needs each cash trade used at most
+    # once too, which a per-coin-trade ROW_NUMBER() can't enforce.
+    if coin_ids is None:
+        candidates = db.execute(SQL_PRICE_CANDIDATES_ALL, params).fetchall()
+    else:
+        coin_ids = set(coin_ids)
+        while True:
+            params['coins'] = json.dumps(sorted(coin_ids))
+            candidates = db.execute(SQL_PRICE_CANDIDATES_SOME, params).fetchall()
+            params['cash'] = json.dumps(sorted({r[1] for r in candidates}))
+            linked = {r[0] for r in db.execute(SQL_PRICE_LINKED_COINS, params)}
+            if not linked:
+                break
+            coin_ids |= linked
+
+    # Greedy pick, closest pairs first. This loop runs once per candidate
+    # pair, so it sticks to tuple unpacking, pre-bound set methods and a
+    # plain list per coin: [sum_coin, sum_cash, matches, updated_at].
+    used_coin, used_cash = set(), set()
+    mark_coin, mark_cash = used_coin.add, used_cash.add
+    totals = {}
+    for coin_tid, cash_tid, coin_id, coin_amt, cash_amt, matched_at in candidates:
+        if coin_tid in used_coin or cash_tid in used_cash:
             continue
-        used_coin_trades.add(coin_tid)
-        used_cash_trades.add(cash_tid)
-
-        coin_id = row['coin_id']
-        stats = implied_by_coin.setdefault(coin_id, {
-            'sum_coin': 0.0,
-            'sum_cash': 0.0,
-            'matches': 0,
-            'updated_at': row['matched_at']
-        })
-        stats['sum_coin'] += float(row['coin_amount'] or 0.0)
-        stats['sum_cash'] += float(row['cash_amount'] or 0.0)
-        stats['matches'] += 1
-        if row['matched_at'] and (not stats['updated_at'] or row['matched_at'] > stats['updated_at']):
-            stats['updated_at'] = row['matched_at']
+        mark_coin(coin_tid)
+        mark_cash(cash_tid)
+
+        t = totals.get(coin_id)
+        if t is None:
+            t = totals[coin_id] = [0.0, 0.0, 0, matched_at]
+        t[0] += coin_amt or 0.0
+        t[1] += cash_amt or 0.0
+        t[2] += 1
+        if matched_at and (not t[3] or matched_at > t[3]):
+            t[3] = matched_at
+
+    if coin_ids is None:
+        db.execute("DELETE FROM implied_prices")
+    else:
+        db.execute("DELETE FROM implied_prices WHERE coin_id IN (SELECT value FROM json_each(?))",
+                   (params['coins'],))
+    db.executemany("""
+        INSERT INTO implied_prices (coin_id, sum_coin, sum_cash, matches, updated_at)
+        VALUES (?, ?, ?, ?, ?)
+    """, [(coin_id, *t) for coin_id, t in totals.items()])
 
+
+def get_implied_prices(db):
+    """Current price of every coin: implied from trades if possible, else the teacher's."""
     base_rows = db.execute("""
         SELECT c.coin_id, c.symbol, c.name,
                COALESCE(p.price, 0.0) AS fallback_price,
-               p.updated_at AS fallback_updated_at
+               p.updated_at AS fallback_updated_at,
+               ip.sum_coin, ip.sum_cash, ip.matches,
+               ip.updated_at AS implied_updated_at
         FROM coins c
         LEFT JOIN prices p ON p.coin_id = c.coin_id
+        LEFT JOIN implied_prices ip ON ip.coin_id = c.coin_id
         ORDER BY c.symbol
     """).fetchall()
 
     out = []
     for r in base_rows:
-        coin_id = r['coin_id']
         symbol = r['symbol']
         if symbol == RESERVE_CURRENCY:
             out.append({
@@ -284,15 +699,14 @@ def get_implied_prices(db, window_seconds=60):
             })
             continue
 
-        stats = implied_by_coin.get(coin_id)
-        if stats and stats['sum_coin'] > 0:
+        if (r['sum_coin'] or 0) > 0:
             out.append({
                 'symbol': symbol,
                 'name': r['name'],
-                'price': stats['sum_cash'] / stats['sum_coin'],
+                'price': r['sum_cash'] / r['sum_coin'],
                 'method': 'implied',
-                'matches': stats['matches'],
-                'updated_at': stats['updated_at']
+                'matches': r['matches'],
+                'updated_at': r['implied_updated_at']
             })
         else:
             out.append({
@@ -305,46 +719,34 @@ def get_implied_prices(db, window_seconds=60):
             })
     return out
 
+@ttl_cache(READ_CACHE_TTL)
+def cached_implied_prices():
+    return get_implied_prices(get_db())
+
 
 def compute_portfolio_value(db, user_id):
     """Returns (cash_classusd, portfolio_value_classusd). Uses prices table."""
-    # Get CLASSUSD coin_id + cash amount
-    res = db.execute("SELECT coin_id FROM coins WHERE symbol=?", (RESERVE_CURRENCY,)).fetchone()
-    reserve_id = res['coin_id']
-    cash, cash_staked = get_balance(db, user_id, reserve_id)
-    cash_total = cash + cash_staked
-
-    rows = db.execute("""
-        SELECT b.coin_id, c.symbol, (b.amount + b.staked) AS units, p.price
+    # Both totals in one pass; the reserve currency is worth 1 by definition.
+    r = db.execute("""
+        SELECT
+            COALESCE(SUM(CASE WHEN c.symbol = :reserve
+                              THEN b.amount + b.staked ELSE 0 END), 0.0) AS cash_total,
+            COALESCE(SUM((b.amount + b.staked) *
+                         CASE WHEN c.symbol = :reserve
+                              THEN 1.0 ELSE COALESCE(p.price, 0.0) END), 0.0) AS total
         FROM balances b
         JOIN coins c ON c.coin_id=b.coin_id
         LEFT JOIN prices p ON p.coin_id=b.coin_id
-        WHERE b.user_id=?
-    """, (user_id,)).fetchall()
-
-    total = 0.0
-    for r in rows:
-        units = float(r['units'] or 0.0)
-        price = float(r['price'] or 0.0)
-        # reserve currency price is 1 by definition
-        if r['symbol'] == RESERVE_CURRENCY:
-            total += units
-        else:
-            total += units * price
-    return cash_total, total
+        WHERE b.user_id = :user
+    """, {'reserve': RESERVE_CURRENCY, 'user': user_id}).fetchone()
+    return r['cash_total'], r['total']
 
 
 def get_balance(db, user_id, coin_id):
-    r = db.execute(
-        "SELECT amount, staked FROM balances WHERE user_id=? AND coin_id=?",
-        (user_id, coin_id)
-    ).fetchone()
+    r = db.execute(SQL_GET_BALANCE, (user_id, coin_id)).fetchone()
     return (r['amount'], r['staked']) if r else (0.0, 0.0)
 
-def set_balance(db, user_id, coin_id, amount, staked=None):
-    if staked is None:
-        _, cur_staked = get_balance(db, user_id, coin_id)
-        staked = cur_staked
+def set_balance(db, user_id, coin_id, amount, staked):
     db.execute("""
         INSERT INTO balances (user_id, coin_id, amount, staked)
         VALUES (?, ?, ?, ?)
@@ -353,15 +755,21 @@ def set_balance(db, user_id, coin_id, amount, staked=None):
     """, (user_id, coin_id, round(amount, 4), round(staked, 4)))
 
 def get_prev_hash(db, coin_id):
-    r = db.execute(
-        "SELECT this_hash FROM ledger_blocks WHERE coin_id=? ORDER BY block_id DESC LIMIT 1",
-        (coin_id,)
-    ).fetchone()
-    return r['this_hash'] if r else '0' * 64
+    # Blocks added during this request update the cache, so each coin's tip
+    # is only read from the table once per request.
+    cache = g._tip_hash_cache
+    if coin_id not in cache:
+        r = db.execute(SQL_PREV_HASH, (coin_id,)).fetchone()
+        cache[coin_id] = r['this_hash'] if r else '0' * 64
+    return cache[coin_id]
+
+# One shared encoder with no spaces after ',' and ':'. json.dumps with
+# custom separators would build a fresh encoder on every call.
+encode_block_data = json.JSONEncoder(separators=(',', ':')).encode
 
 def add_block(db, trade_id, coin_id, from_user_id, to_user_id, amount, executed_at):
     prev_hash  = get_prev_hash(db, coin_id)
-    block_data = json.dumps({
+    block_data = encode_block_data({
         'trade_id': trade_id, 'coin_id': coin_id,
         'from_user_id': from_user_id, 'to_user_id': to_user_id,
         'amount': amount, 'executed_at': executed_at
@@ -373,12 +781,15 @@ def add_block(db, trade_id, coin_id, from_user_id, to_user_id, amount, executed_
         INSERT INTO ledger_blocks (coin_id, trade_id, prev_hash, block_data, this_hash)
         VALUES (?, ?, ?, ?, ?)
     """, (coin_id, trade_id, prev_hash, block_data, this_hash))
+    g._tip_hash_cache[coin_id] = this_hash
     return this_hash
 
 def do_transfer(db, from_user_id, to_user_id, coin_id, amount,
-                trade_type='transfer', note=''):
+                trade_type='transfer', note='', refresh_prices=True):
     """
     Core transfer function. Applies burn, anti-whale, records trade + block.
+    Pass refresh_prices=False when the caller refreshes implied prices itself
+    after a batch of transfers.
     Returns (trade_id, burned, received, error_string)
     """
     coin = db.execute("SELECT * FROM coins WHERE coin_id=?", (coin_id,)).fetchone()
@@ -388,38 +799,199 @@ def do_transfer(db, from_user_id, to_user_id, coin_id, amount,
     burned   = round(amount * coin['burn_rate'], 4) if trade_type == 'transfer' else 0.0
     received = round(amount - burned, 4)
 
-    # Anti-whale check
-    if coin['max_holding'] and to_user_id:
-        cur_bal, _ = get_balance(db, to_user_id, coin_id)
-        if cur_bal + received > coin['max_holding']:
+    # Both balance rules are checked inside the statements that move the
+    # coins, so there's no separate read that another request could change
+    # first. If either rule fails, the savepoint undoes what was written.
+    db.execute("SAVEPOINT transfer")
+
+    # Credit recipient — the anti-whale limit is part of the UPSERT, so if it
+    # would be broken no row is written and nothing comes back.
+    if to_user_id is not None:
+        credited = db.execute("""
+            INSERT INTO balances (user_id, coin_id, amount, staked)
+            SELECT :to, :coin, :received, 0
+            WHERE :max IS NULL OR :received <= :max
+            ON CONFLICT(user_id, coin_id)
+            DO UPDATE SET amount = ROUND(amount + excluded.amount, 4)
+            WHERE :max IS NULL OR amount + excluded.amount <= :max
+            RETURNING amount
+        """, {'to': to_user_id, 'coin': coin_id, 'received': received,
+              'max': coin['max_holding'] or None}).fetchone()
+        if not credited:
+            db.execute("ROLLBACK TO transfer")
+            db.execute("RELEASE transfer")
+            cur_bal, _ = get_balance(db, to_user_id, coin_id)
             return None, 0, 0, (
                 f"Anti-whale limit: {coin['symbol']} holders can't exceed "
                 f"{coin['max_holding']:.2f}. Recipient has {cur_bal:.2f}."
             )
 
-    # Deduct from sender
+    # Deduct from sender — the balance check is part of the UPDATE itself.
     if from_user_id is not None:
-        s_bal, s_staked = get_balance(db, from_user_id, coin_id)
-        if s_bal < amount:
+        debited = db.execute("""
+            UPDATE balances SET amount = ROUND(amount - ?, 4)
+            WHERE user_id=? AND coin_id=? AND amount >= ?
+            RETURNING amount
+        """, (amount, from_user_id, coin_id, amount)).fetchone()
+        if not debited:
+            db.execute("ROLLBACK TO transfer")
+            db.execute("RELEASE transfer")
+            s_bal, _ = get_balance(db, from_user_id, coin_id)
             return None, 0, 0, f'Insufficient balance. You have {s_bal:.4f} {coin["symbol"]}.'
-        set_balance(db, from_user_id, coin_id, s_bal - amount)
-
-    # Credit recipient
-    if to_user_id is not None:
-        r_bal, _ = get_balance(db, to_user_id, coin_id)
-        set_balance(db, to_user_id, coin_id, r_bal + received)
 
-    ts = now_iso()
-    db.execute("""
+    ts, epoch = now_stamp()
+    trade_id = db.execute("""
         INSERT INTO trades
-            (from_user_id, to_user_id, coin_id, amount, burned_amount, trade_type, note, executed_at)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-    """, (from_user_id, to_user_id, coin_id, amount, burned, trade_type, note, ts))
-    trade_id = db.execute("SELECT last_insert_rowid() AS id").fetchone()['id']
+            (from_user_id, to_user_id, coin_id, amount, burned_amount, trade_type, note,
+             executed_at, executed_at_epoch)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        RETURNING trade_id
+    """, (from_user_id, to_user_id, coin_id, amount, burned, trade_type, note, ts, epoch)).fetchone()[0]
 
     add_block(db, trade_id, coin_id, from_user_id, to_user_id, amount, ts)
+    if trade_type == 'transfer' and refresh_prices:
+        refresh_implied_prices(db, coin_ids=(coin_id,))
+    db.execute("RELEASE transfer")
     return trade_id, burned, received, None
 
+def do_transfer_bulk(db, coin, recipients, amount, trade_type, note=''):
+    """
+    System payout of `amount` of `coin` to many users at once (airdrops).
+    `recipients` is a list of (user_id, current_amount) rows. Skips anyone
+    the anti-whale limit would push over, same as do_transfer.
+    Writes balances, trades and blocks with one executemany each.
+    Must run inside a write transaction (trade_ids are read back by range).
+    Returns the list of new trade_ids.
+    """
+    coin_id  = coin['coin_id']
+    received = round(amount, 4)
+    max_hold = coin['max_holding']
+    paid     = [(uid, bal) for uid, bal in recipients
+                if not (max_hold and bal + received > max_hold)]
+    if not paid:
+        return []
+
+    db.executemany(
+        "UPDATE balances SET amount=? WHERE user_id=? AND coin_id=?",
+        [(round(bal + received, 4), uid, coin_id) for uid, bal in paid]
+    )
+
+    ts, epoch = now_stamp()
+    last_id   = db.execute("SELECT COALESCE(MAX(trade_id), 0) FROM trades").fetchone()[0]
+    db.executemany("""
+        INSERT INTO trades
+            (from_user_id, to_user_id, coin_id, amount, burned_amount, trade_type, note,
+             executed_at, executed_at_epoch)
+        VALUES (NULL, ?, ?, ?, 0, ?, ?, ?, ?)
+    """, [(uid, coin_id, amount, trade_type, note, ts, epoch) for uid, _ in paid])
+    trade_ids = [r[0] for r in db.execute(
+        "SELECT trade_id FROM trades WHERE trade_id > ? ORDER BY trade_id", (last_id,)
+    )]
+
+    # Chain the blocks in Python: each new block's prev_hash is the hash we
+    # just computed, so the tip is only read from the table once.
+    prev_hash = get_prev_hash(db, coin_id)
+    blocks    = []
+    for trade_id, (uid, _) in zip(trade_ids, paid):
+        block_data = encode_block_data({
+            'trade_id': trade_id, 'coin_id': coin_id,
+            'from_user_id': None, 'to_user_id': uid,
+            'amount': amount, 'executed_at': ts
+        })
+        this_hash = compute_block_hash(prev_hash, trade_id, None, uid, coin_id, amount, ts)
+        blocks.append((coin_id, trade_id, prev_hash, block_data, this_hash))
+        prev_hash = this_hash
+    db.executemany("""
+        INSERT INTO ledger_blocks (coin_id, trade_id, prev_hash, block_data, this_hash)
+        VALUES (?, ?, ?, ?, ?)
+    """, blocks)
+    g._tip_hash_cache[coin_id] = prev_hash
+    return trade_ids
+
+
+# ─────────────────────────────────────────
+#  WRITE BATCHING
+# ─────────────────────────────────────────
+
+# During class everyone sends at once, and every commit waits on the disk.
+# Instead of each /api/send committing on its own, requests hand their
+# transfer to one writer thread, which runs whatever has queued up in a
+# single transaction — one commit for the whole batch.
+_write_q = queue.SimpleQueue()
+_writer_lock = threading.Lock()
+_writer_started = False
+
+def _drain_writes():
+    """Block for the first queued transfer, then take whatever else arrives
+    within WRITE_BATCH_WAIT, up to WRITE_BATCH_MAX."""
+    batch    = [_write_q.get()]
+    deadline = time.monotonic() + WRITE_BATCH_WAIT
+    while len(batch) < WRITE_BATCH_MAX:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        try:
+            batch.append(_write_q.get(timeout=remaining))
+        except queue.Empty:
+            break
+    return batch
+
+def _run_write_batch(batch):
+    with app.app_context():
+        db = get_db()
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            results = []
+            for args, _, _ in batch:
+                # A transfer that blows up only loses its own writes, not
+                # everyone else's in the batch.
+                db.execute("SAVEPOINT batch_item")
+                try:
+                    res = do_transfer(db, *args, refresh_prices=False)
+                except Exception:
+                    app.logger.exception('Transfer failed in write batch')
+                    db.execute("ROLLBACK TO batch_item")
+                    res = (None, 0, 0, 'Transfer failed. Please try again.')
+                db.execute("RELEASE batch_item")
+                results.append(res)
+            traded = {args[2] for (args, _, _), (_, _, _, err) in zip(batch, results)
+                      if err is None}
+            if traded:
+                refresh_implied_prices(db, coin_ids=traded)
+            db.commit()
+        except Exception:
+            app.logger.exception('Write batch failed')
+            if db.in_transaction:
+                db.rollback()
+            results = [(None, 0, 0, 'Transfer failed. Please try again.')] * len(batch)
+    for (_, done, slot), res in zip(batch, results):
+        slot.append(res)
+        done.set()
+
+def _transfer_writer():
+    while True:
+        _run_write_batch(_drain_writes())
+
+def submit_transfer(from_user_id, to_user_id, coin_id, amount, note=''):
+    """
+    Queue a user-to-user transfer for the writer thread and wait for it.
+    Returns do_transfer's (trade_id, burned, received, error_string), or
+    None if the writer didn't answer within WRITE_TIMEOUT.
+    """
+    global _writer_started
+    if not _writer_started:
+        with _writer_lock:
+            if not _writer_started:
+                threading.Thread(target=_transfer_writer, name='transfer-writer',
+                                 daemon=True).start()
+                _writer_started = True
+
+    done, slot = threading.Event(), []
+    _write_q.put(((from_user_id, to_user_id, coin_id, amount, 'transfer', note), done, slot))
+    if not done.wait(WRITE_TIMEOUT):
+        return None
+    return slot[0]
+
 
 # ─────────────────────────────────────────
 #  AUTH
@@ -427,6 +999,7 @@ def do_transfer(db, from_user_id, to_user_id, coin_id, amount,
 
 @app.route('/api/register', methods=['POST'])
 def register():
+    global _users_ver
     d      = request.json
     handle = (d.get('username') or '').strip().lower()
     pw     = d.get('password') or ''
@@ -441,18 +1014,24 @@ def register():
     db = get_db()
     if db.execute("SELECT 1 FROM users WHERE handle=?", (handle,)).fetchone():
         return jsonify(error='Username already taken.'), 400
+    pw_hash = hash_password(pw)   # slow on purpose, so done before locking
+    coin_id = get_reserve_id(db)
 
-    db.execute("INSERT INTO users (handle, password_hash) VALUES (?,?)",
-               (handle, hash_password(pw)))
-    db.commit()
-    user_id  = db.execute("SELECT user_id FROM users WHERE handle=?", (handle,)).fetchone()['user_id']
-    coin_id  = get_reserve_id(db)
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        user_id = db.execute("INSERT INTO users (handle, password_hash) VALUES (?,?) RETURNING user_id",
+                             (handle, pw_hash)).fetchone()[0]
+    except sqlite3.IntegrityError:
+        db.rollback()   # someone took the name while we were hashing
+        return jsonify(error='Username already taken.'), 400
 
     _, _, _, err = do_transfer(db, None, user_id, coin_id, STARTING_BALANCE,
                                'welcome', 'Welcome bonus!')
     if err:
+        db.rollback()
         return jsonify(error=err), 500
     db.commit()
+    _users_ver = next(_users_versions)   # /api/users must rebuild its list
     return jsonify(success=True, username=handle)
 
 
@@ -462,8 +1041,8 @@ def login():
     handle = (d.get('username') or '').strip().lower()
     pw     = d.get('password') or ''
     db     = get_db()
-    row    = db.execute("SELECT user_id, password_hash FROM users WHERE handle=?", (handle,)).fetchone()
-    if not row or row['password_hash'] != hash_password(pw):
+    row    = db.execute(SQL_USER_AUTH, (handle,)).fetchone()
+    if not row or not verify_password(pw, row['password_hash']):
         return jsonify(error='Invalid username or password.'), 401
     return jsonify(success=True, username=handle)
 
@@ -472,16 +1051,19 @@ def login():
 #  COINS
 # ─────────────────────────────────────────
 
-@app.route('/api/coins', methods=['GET'])
-def list_coins():
-    db   = get_db()
-    rows = db.execute("""
+@ttl_cache(READ_CACHE_TTL)
+def coin_rows():
+    rows = get_db().execute("""
         SELECT c.*, u.handle AS creator_name
         FROM coins c
         LEFT JOIN users u ON c.creator_id = u.user_id
         ORDER BY c.created_at DESC
     """).fetchall()
-    return jsonify([dict(r) for r in rows])
+    return rows
+
+@app.route('/api/coins', methods=['GET'])
+def list_coins():
+    return jsonify(coin_rows())
 
 
 @app.route('/api/coins/create', methods=['POST'])
@@ -518,37 +1100,39 @@ def create_coin():
         return jsonify(error='Invalid supply or burn rate.'), 400
 
     db  = get_db()
-    row = db.execute("SELECT user_id, password_hash FROM users WHERE handle=?", (handle,)).fetchone()
-    if not row or row['password_hash'] != hash_password(pw):
+    row = db.execute(SQL_USER_AUTH, (handle,)).fetchone()
+    if not row or not verify_password(pw, row['password_hash']):
         return jsonify(error='Invalid credentials.'), 401
 
     user_id = row['user_id']
+    db.execute("BEGIN IMMEDIATE")
 
     # One coin per student
     if db.execute("SELECT 1 FROM coins WHERE creator_id=?", (user_id,)).fetchone():
+        db.rollback()
         return jsonify(error='You already have a coin. Each student gets one.'), 400
     if db.execute("SELECT 1 FROM coins WHERE symbol=?", (symbol,)).fetchone():
+        db.rollback()
         return jsonify(error=f'Symbol {symbol} already taken.'), 400
 
-    db.execute("""
+    coin_id = db.execute("""
         INSERT INTO coins
             (symbol, name, creator_id, total_supply, burn_rate,
              airdrop_amount, max_holding, staking_enabled, description)
         VALUES (?,?,?,?,?,?,?,?,?)
+        RETURNING coin_id
     """, (symbol, name, user_id, supply, burn,
-          airdrop, max_hold, staking, desc))
-    db.commit()
-
-    coin_id = db.execute("SELECT coin_id FROM coins WHERE symbol=?", (symbol,)).fetchone()['coin_id']
+          airdrop, max_hold, staking, desc)).fetchone()[0]
 
     # Creator gets the full supply
-    set_balance(db, user_id, coin_id, supply)
-    ts = now_iso()
-    db.execute("""
-        INSERT INTO trades (from_user_id, to_user_id, coin_id, amount, burned_amount, trade_type, note, executed_at)
-        VALUES (NULL, ?, ?, ?, 0, 'welcome', 'Initial coin supply', ?)
-    """, (user_id, coin_id, supply, ts))
-    trade_id = db.execute("SELECT last_insert_rowid() AS id").fetchone()['id']
+    set_balance(db, user_id, coin_id, supply, 0.0)
+    ts, epoch = now_stamp()
+    trade_id = db.execute("""
+        INSERT INTO trades (from_user_id, to_user_id, coin_id, amount, burned_amount, trade_type, note,
+                            executed_at, executed_at_epoch)
+        VALUES (NULL, ?, ?, ?, 0, 'welcome', 'Initial coin supply', ?, ?)
+        RETURNING trade_id
+    """, (user_id, coin_id, supply, ts, epoch)).fetchone()[0]
     add_block(db, trade_id, coin_id, None, user_id, supply, ts)
     db.commit()
 
@@ -579,25 +1163,25 @@ def send():
         return jsonify(error='Cannot send to yourself.'), 400
 
     db     = get_db()
-    sender = db.execute("SELECT user_id, password_hash FROM users WHERE handle=?", (from_handle,)).fetchone()
-    if not sender or sender['password_hash'] != hash_password(pw):
+    sender = db.execute(SQL_USER_AUTH, (from_handle,)).fetchone()
+    if not sender or not verify_password(pw, sender['password_hash']):
         return jsonify(error='Invalid credentials.'), 401
 
-    recip = db.execute("SELECT user_id FROM users WHERE handle=?", (to_handle,)).fetchone()
-    if not recip:
+    recip_id = lookup_user_id(db, to_handle)
+    if recip_id is None:
         return jsonify(error=f'User "{to_handle}" not found.'), 404
 
-    coin = db.execute("SELECT coin_id FROM coins WHERE symbol=?", (symbol,)).fetchone()
-    if not coin:
+    coin_id = lookup_coin_id(db, symbol)
+    if coin_id is None:
         return jsonify(error=f'Coin "{symbol}" not found.'), 404
 
-    trade_id, burned, received, err = do_transfer(
-        db, sender['user_id'], recip['user_id'], coin['coin_id'], amount, 'transfer', note
-    )
+    result = submit_transfer(sender['user_id'], recip_id, coin_id, amount, note)
+    if result is None:
+        return jsonify(error='Server is busy. Check your wallet before sending again.'), 503
+    trade_id, burned, received, err = result
     if err:
         return jsonify(error=err), 400
 
-    db.commit()
     return jsonify(success=True, trade_id=trade_id, burned=burned, received=received)
 
 
@@ -614,8 +1198,8 @@ def airdrop():
     symbol = (d.get('symbol') or '').strip().upper()
 
     db     = get_db()
-    user   = db.execute("SELECT user_id, password_hash FROM users WHERE handle=?", (handle,)).fetchone()
-    if not user or user['password_hash'] != hash_password(pw):
+    user   = db.execute(SQL_USER_AUTH, (handle,)).fetchone()
+    if not user or not verify_password(pw, user['password_hash']):
         return jsonify(error='Invalid credentials.'), 401
 
     coin = db.execute("""
@@ -626,23 +1210,23 @@ def airdrop():
     if coin['airdrop_amount'] <= 0:
         return jsonify(error='This coin has no airdrop amount configured.'), 400
 
+    # Take the write lock before reading balances, so nobody else's
+    # transfer lands between the read and the bulk update.
+    db.execute("BEGIN IMMEDIATE")
+
     # Get all holders (excluding creator to avoid self-airdrop)
     holders = db.execute("""
-        SELECT user_id FROM balances
+        SELECT user_id, amount FROM balances
         WHERE coin_id=? AND user_id != ? AND amount > 0
     """, (coin['coin_id'], user['user_id'])).fetchall()
 
     if not holders:
+        db.rollback()
         return jsonify(error='No other holders yet — send your coin to classmates first.'), 400
 
-    count = 0
-    for h in holders:
-        _, _, _, err = do_transfer(
-            db, None, h['user_id'], coin['coin_id'],
-            coin['airdrop_amount'], 'airdrop', f'Airdrop from {handle}'
-        )
-        if not err:
-            count += 1
+    trade_ids = do_transfer_bulk(db, coin, holders, coin['airdrop_amount'],
+                                 'airdrop', f'Airdrop from {handle}')
+    count     = len(trade_ids)
 
     db.commit()
     return jsonify(success=True, recipients=count,
@@ -664,8 +1248,8 @@ def stake():
         return jsonify(error='Invalid amount.'), 400
 
     db   = get_db()
-    user = db.execute("SELECT user_id, password_hash FROM users WHERE handle=?", (handle,)).fetchone()
-    if not user or user['password_hash'] != hash_password(pw):
+    user = db.execute(SQL_USER_AUTH, (handle,)).fetchone()
+    if not user or not verify_password(pw, user['password_hash']):
         return jsonify(error='Invalid credentials.'), 401
 
     coin = db.execute("SELECT * FROM coins WHERE symbol=?", (symbol,)).fetchone()
@@ -676,6 +1260,9 @@ def stake():
 
     uid     = user['user_id']
     cid     = coin['coin_id']
+    # Lock before reading the balance the new one is computed from. Any
+    # early return below leaves the transaction to close_db to roll back.
+    db.execute("BEGIN IMMEDIATE")
     bal, staked = get_balance(db, uid, cid)
 
     if action == 'stake':
@@ -712,10 +1299,21 @@ def stake():
 
 @app.route('/api/wallet/<username>')
 def wallet(username):
-    db   = get_db()
-    user = db.execute("SELECT user_id FROM users WHERE handle=?", (username.lower(),)).fetchone()
-    if not user: return jsonify(error='User not found.'), 404
-    uid = user['user_id']
+    db = get_db()
+    # The user and their coin (if any) in one lookup
+    me = db.execute("""
+        SELECT c.*, u.handle AS creator_name, u.user_id AS wallet_user_id
+        FROM users u
+        LEFT JOIN coins c ON c.creator_id = u.user_id
+        WHERE u.handle=?
+    """, (username.lower(),)).fetchone()
+    if not me: return jsonify(error='User not found.'), 404
+    uid = me['wallet_user_id']
+
+    my_coin = None
+    if me['coin_id'] is not None:
+        my_coin = dict(me)
+        del my_coin['wallet_user_id']
 
     # All balances for this user
     bals = db.execute("""
@@ -741,42 +1339,39 @@ def wallet(username):
         ORDER BY t.executed_at DESC LIMIT 60
     """, (uid, uid)).fetchall()
 
-    # My coin (if any)
-    my_coin = db.execute("""
-        SELECT c.*, u.handle AS creator_name
-        FROM coins c LEFT JOIN users u ON c.creator_id = u.user_id
-        WHERE c.creator_id=?
-    """, (uid,)).fetchone()
-
     return jsonify(
         username=username.lower(),
-        balances=[dict(b) for b in bals],
-        transactions=[dict(t) for t in trades],
-        my_coin=dict(my_coin) if my_coin else None
+        balances=bals,
+        transactions=trades,
+        my_coin=my_coin
     )
 
 
-@app.route('/api/leaderboard')
-def leaderboard():
-    symbol = request.args.get('symbol', RESERVE_CURRENCY).upper()
-    db     = get_db()
-    rows   = db.execute("""
+@ttl_cache(READ_CACHE_TTL)
+def leaderboard_rows(coin_id):
+    rows = get_db().execute("""
         SELECT u.handle, b.amount, b.staked
         FROM balances b
         JOIN users u ON b.user_id = u.user_id
-        JOIN coins c ON b.coin_id = c.coin_id
-        WHERE c.symbol = ?
+        WHERE b.coin_id = ?
         ORDER BY b.amount DESC
-    """, (symbol,)).fetchall()
-    return jsonify([dict(r) for r in rows])
+    """, (coin_id,)).fetchall()
+    return rows
+
+@app.route('/api/leaderboard')
+def leaderboard():
+    symbol = request.args.get('symbol', RESERVE_CURRENCY).upper()
+    # Unknown symbols are answered here, so they never become cache keys
+    coin_id = lookup_coin_id(get_db(), symbol)
+    if coin_id is None:
+        return jsonify([])
+    return jsonify(leaderboard_rows(coin_id))
 
 
 
 @app.route('/api/prices')
 def api_prices():
-    db = get_db()
-    rows = get_implied_prices(db, window_seconds=60)
-    return jsonify(rows)
+    return jsonify(cached_implied_prices())
 
 
 @app.route('/api/prices/set', methods=['POST'])
@@ -796,54 +1391,82 @@ def api_prices_set():
         return jsonify(error='Price must be >= 0.'), 400
 
     db = get_db()
-    coin = db.execute("SELECT coin_id FROM coins WHERE symbol=?", (symbol,)).fetchone()
-    if not coin:
+    coin_id = lookup_coin_id(db, symbol)
+    if coin_id is None:
         return jsonify(error='Coin not found.'), 404
 
     db.execute("""
         INSERT INTO prices(coin_id, price, updated_at)
         VALUES (?,?,?)
         ON CONFLICT(coin_id) DO UPDATE SET price=excluded.price, updated_at=excluded.updated_at
-    """, (coin['coin_id'], price, now_iso()))
+    """, (coin_id, price, now_iso()))
     db.commit()
     return jsonify(success=True, symbol=symbol, price=price)
 
 
+@ttl_cache(READ_CACHE_TTL)
+def portfolio_rows():
+    db = get_db()
+    price_rows = cached_implied_prices()
+
+    # One grouped query for every user; the current prices go in as a
+    # VALUES list so they can be joined like a table.
+    px_values = ', '.join(['(?, ?)'] * len(price_rows))
+    params = [v for p in price_rows for v in (p['symbol'], float(p.get('price') or 0.0))]
+    rows = db.execute(f"""
+        WITH px(symbol, price) AS (VALUES {px_values})
+        SELECT u.handle,
+               COALESCE(SUM(CASE WHEN c.symbol = ?
+                                 THEN b.amount + b.staked ELSE 0 END), 0.0) AS cash,
+               COALESCE(SUM(CASE WHEN c.symbol = ?
+                                 THEN b.amount + b.staked
+                                 ELSE (b.amount + b.staked) * COALESCE(px.price, 0.0) END), 0.0) AS portfolio
+        FROM users u
+        LEFT JOIN balances b ON b.user_id = u.user_id
+        LEFT JOIN coins c    ON c.coin_id = b.coin_id
+        LEFT JOIN px         ON px.symbol = c.symbol
+        GROUP BY u.user_id
+        -- The per-user loop this replaced read users with no ORDER BY, which
+        -- SQLite serves from the UNIQUE(handle) index, i.e. by handle. Keep
+        -- that order so equal portfolios come out as they always did.
+        ORDER BY u.handle
+    """, params + [RESERVE_CURRENCY, RESERVE_CURRENCY]).fetchall()
+    out = [{"username": r["handle"], "cash": round(r["cash"], 2), "portfolio": round(r["portfolio"], 2)}
+           for r in rows]
+    out.sort(key=lambda x: x["portfolio"], reverse=True)
+    return out
+
 @app.route('/api/portfolio_leaderboard')
 def api_portfolio_leaderboard():
     """Leaderboard ranked by implied-valuation portfolio value in CLASSUSD."""
-    db = get_db()
-    price_rows = get_implied_prices(db, window_seconds=60)
-    price_map = {p['symbol']: float(p.get('price') or 0.0) for p in price_rows}
-    users = db.execute("SELECT user_id, handle FROM users").fetchall()
-    out = []
-    for u in users:
-        bals = db.execute("""
-            SELECT c.symbol, (b.amount + b.staked) AS units
-            FROM balances b
-            JOIN coins c ON c.coin_id = b.coin_id
-            WHERE b.user_id=?
-        """, (u['user_id'],)).fetchall()
-        total = 0.0
-        cash = 0.0
-        for b in bals:
-            symbol = b['symbol']
-            units = float(b['units'] or 0.0)
-            if symbol == RESERVE_CURRENCY:
-                cash += units
-                total += units
-            else:
-                total += units * float(price_map.get(symbol, 0.0))
-        out.append({"username": u["handle"], "cash": round(cash,2), "portfolio": round(total,2)})
-    out.sort(key=lambda x: x["portfolio"], reverse=True)
-    return jsonify(out)
+    return jsonify(portfolio_rows())
 
 
 @app.route('/api/ledger')
 def ledger():
+    """
+    Trades, newest first. ?symbol= filters to one coin. ?limit= returns one
+    page (at most LEDGER_PAGE_MAX trades); pass the last trade_id you got as
+    ?after_trade_id= for the next.
+    """
     symbol = request.args.get('symbol', '').upper()
+    after  = request.args.get('after_trade_id', type=int)
+    limit  = request.args.get('limit', type=int)
+    # SQLite reads a negative LIMIT as "no limit", so those never get through
+    if limit is not None:
+        if limit < 1:
+            return jsonify(error='limit must be at least 1.'), 400
+        limit = min(limit, LEDGER_PAGE_MAX)
     db     = get_db()
-    query  = """
+
+    where, params = [], []
+    if symbol:
+        where.append("c.symbol=?")
+        params.append(symbol)
+    if after is not None:
+        where.append("t.trade_id < ?")   # keyset: no OFFSET rows to skip
+        params.append(after)
+    cur = db.execute(f"""
         SELECT t.trade_id, lb.block_id, COALESCE(s.handle,'SYSTEM') AS from_user,
                r.handle AS to_user, c.symbol, t.amount,
                t.burned_amount, t.trade_type, t.note, t.executed_at,
@@ -853,58 +1476,102 @@ def ledger():
         JOIN  users r ON t.to_user_id = r.user_id
         JOIN  coins c ON t.coin_id = c.coin_id
         LEFT JOIN ledger_blocks lb ON lb.trade_id = t.trade_id
-        {where}
-        ORDER BY t.executed_at DESC
-    """
-    if symbol:
-        rows = db.execute(query.format(where="WHERE c.symbol=?"), (symbol,)).fetchall()
-    else:
-        rows = db.execute(query.format(where="")).fetchall()
-    return jsonify([dict(r) for r in rows])
+        {'WHERE ' + ' AND '.join(where) if where else ''}
+        ORDER BY t.trade_id DESC
+        {'LIMIT ?' if limit is not None else ''}
+    """, params + ([limit] if limit is not None else []))
+
+    # Written out a few hundred rows at a time as they come off the cursor,
+    # so the full ledger is never held in memory at once.
+    def generate():
+        keys  = [d[0] for d in cur.description]
+        dumps = app.json.dumps
+        sep   = ''
+        yield '['
+        while batch := cur.fetchmany(500):
+            yield sep + dumps([dict(zip(keys, r)) for r in batch],
+                              separators=(',', ':'))[1:-1]
+            sep = ','
+        yield ']'
+
+    return Response(stream_with_context(generate()), mimetype='application/json')
 
 
 @app.route('/api/chain')
 def chain():
     symbol = request.args.get('symbol', RESERVE_CURRENCY).upper()
     db     = get_db()
-    coin   = db.execute("SELECT coin_id FROM coins WHERE symbol=?", (symbol,)).fetchone()
-    if not coin: return jsonify(error='Coin not found.'), 404
-
-    blocks = db.execute("""
-        SELECT lb.*, COALESCE(s.handle,'SYSTEM') AS from_user, r.handle AS to_user,
-               t.amount, t.trade_type, t.executed_at AS trade_time
-        FROM ledger_blocks lb
-        JOIN  trades t ON lb.trade_id = t.trade_id
-        LEFT JOIN users s ON t.from_user_id = s.user_id
-        JOIN  users r ON t.to_user_id = r.user_id
-        WHERE lb.coin_id=?
-        ORDER BY lb.block_id ASC
-    """, (coin['coin_id'],)).fetchall()
+    coin_id = lookup_coin_id(db, symbol)
+    if coin_id is None: return jsonify(error='Coin not found.'), 404
+
+    # The blocks and the saved state are read in one transaction, so both
+    # come from the same snapshot of the database.
+    db.execute("BEGIN")
+    blocks = db.execute(SQL_CHAIN_BLOCKS, (coin_id,)).fetchall()
 
     blocks = [dict(b) for b in blocks]
+
+    # Blocks up to the last one verified before are trusted, as long as that
+    # block still carries the hash it had then; the triggers in init_db drop
+    # the saved state when older blocks or trades change. ?full=1 rechecks
+    # everything (student/verify_chain.py always does).
+    start, prev = 0, '0' * 64
+    state = db.execute(SQL_CHAIN_STATE, (coin_id,)).fetchone()
+    if state and request.args.get('full') != '1':
+        for i, b in enumerate(blocks):
+            if b['block_id'] == state['last_block_id']:
+                if b['this_hash'] == state['last_hash']:
+                    start, prev = i + 1, b['this_hash']
+                break
+
     valid, bad = True, None
-    for i, b in enumerate(blocks):
-        expected_prev = blocks[i-1]['this_hash'] if i > 0 else '0' * 64
-        if b['prev_hash'] != expected_prev:
+    for b in blocks[start:]:
+        if b['prev_hash'] != prev:
             valid, bad = False, b['block_id']
             break
         expected_hash = compute_block_hash(
-            b['prev_hash'], b['trade_id'], None if b['from_user'] == 'SYSTEM' else
-            db.execute("SELECT user_id FROM users WHERE handle=?", (b['from_user'],)).fetchone()['user_id'],
-            db.execute("SELECT user_id FROM users WHERE handle=?", (b['to_user'],)).fetchone()['user_id'],
-            coin['coin_id'], b['amount'], b['trade_time']
+            b['prev_hash'], b['trade_id'], b['from_user_id'], b['to_user_id'],
+            coin_id, b['amount'], b['trade_time']
         )
         if b['this_hash'] != expected_hash:
             valid, bad = False, b['block_id']
             break
+        prev = b['this_hash']
+
+    # Still inside the read transaction: SQLite only lets it start writing
+    # if nothing was committed since the snapshot, so state is never saved
+    # for blocks an edit has changed in the meantime. A busy database just
+    # means the state isn't updated this time.
+    try:
+        if not valid:
+            db.execute("DELETE FROM chain_verify_state WHERE coin_id=?", (coin_id,))
+        elif blocks and start < len(blocks):
+            tip = blocks[-1]
+            db.execute(SQL_SAVE_CHAIN_STATE, (coin_id, tip['block_id'], tip['this_hash'], now_iso()))
+        db.commit()
+    except sqlite3.OperationalError:
+        db.rollback()
 
     return jsonify(is_valid=valid, first_bad_block=bad, blocks=blocks)
 
 
+# The handle list only changes when someone registers, so its JSON is kept
+# until register() moves _users_ver on. Each bump is a number never used
+# before, so a list built before a registration can never look current.
+_users_versions = itertools.count(1)
+_users_ver   = 0
+_users_cache = (-1, None)   # (version it was built at, JSON body)
+
 @app.route('/api/users')
 def users():
-    db = get_db()
-    return jsonify([r['handle'] for r in db.execute("SELECT handle FROM users ORDER BY handle").fetchall()])
+    global _users_cache
+    ver = _users_ver            # read before the query, not after
+    built_at, body = _users_cache
+    if built_at != ver:
+        handles = [r[0] for r in get_db().execute("SELECT handle FROM users ORDER BY handle")]
+        body = app.json.dumps(handles, separators=(',', ':'))
+        _users_cache = (ver, body)
+    return Response(body, mimetype='application/json')
 
 
 # ─────────────────────────────────────────
@@ -914,52 +1581,107 @@ def users():
 @app.route('/api/export/csv')
 def export_csv():
     db   = get_db()
-    rows = db.execute("""
-        SELECT t.trade_id, COALESCE(s.handle,'SYSTEM') AS from_user,
-               r.handle AS to_user, c.symbol, t.amount, t.burned_amount,
-               t.trade_type, t.note, t.executed_at, lb.prev_hash, lb.this_hash
-        FROM trades t
-        LEFT JOIN users s ON t.from_user_id = s.user_id
-        JOIN  users r ON t.to_user_id = r.user_id
-        JOIN  coins c ON t.coin_id = c.coin_id
-        LEFT JOIN ledger_blocks lb ON lb.trade_id = t.trade_id
-        ORDER BY t.trade_id
-    """).fetchall()
-    out = io.StringIO()
-    w   = csv.writer(out)
-    w.writerow(['trade_id','from_user','to_user','symbol','amount','burned_amount',
-                'trade_type','note','executed_at','prev_hash','this_hash'])
-    for r in rows: w.writerow(list(r))
-    out.seek(0)
-    return send_file(io.BytesIO(out.getvalue().encode()), mimetype='text/csv',
-                     as_attachment=True, download_name='classusd_trades.csv')
+    cur  = db.execute(SQL_EXPORT_CSV)
+
+    # Rows are written out a batch at a time as they come off the cursor, so
+    # the download starts right away and the whole ledger is never held in
+    # memory. writerows() takes the rows as they are — no list() per row.
+    def generate():
+        out = io.StringIO()
+        w   = csv.writer(out)
+        w.writerow(['trade_id','from_user','to_user','symbol','amount','burned_amount',
+                    'trade_type','note','executed_at','prev_hash','this_hash'])
+        yield out.getvalue()
+        while batch := cur.fetchmany(1000):
+            out.seek(0)
+            out.truncate(0)
+            w.writerows(batch)
+            yield out.getvalue()
+
+    return Response(stream_with_context(generate()), mimetype='text/csv',
+                    headers={'Content-Disposition': 'attachment; filename=classusd_trades.csv'})
 
 
 @app.route('/api/export/db')
 def export_db():
-    return send_file(os.path.abspath(DB_PATH), mimetype='application/octet-stream',
+    # In WAL mode the newest commits may still be in classusd.db-wal, so the
+    # main file alone can be out of date. VACUUM INTO writes a complete,
+    # consistent copy; send_file then hands the open file to the server,
+    # which can use sendfile() instead of copying it through Python.
+    fd, snap = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    try:
+        get_db().execute("VACUUM INTO ?", (snap,))
+        # O_TEMPORARY (Windows only) deletes the file once it's closed
+        snap_file = open(snap, 'rb',
+                         opener=lambda p, fl: os.open(p, fl | getattr(os, 'O_TEMPORARY', 0)))
+    finally:
+        try:
+            os.remove(snap)   # the open handle can still be read to the end
+        except OSError:
+            pass              # Windows: removed when snap_file is closed
+    resp = send_file(snap_file, mimetype='application/octet-stream',
                      as_attachment=True, download_name='classusd.db')
+    resp.content_length = os.fstat(snap_file.fileno()).st_size
+    return resp
 
 
+# The schema text is rebuilt only when SQLite's schema_version moves, which
+# any CREATE/ALTER/DROP does — including ones run from lab.py or another
+# tool against the same file.
+_schema_cache = (None, None)   # (schema_version, text)
+
 @app.route('/api/export/schema')
 def export_schema():
-    db   = get_db()
-    rows = db.execute("""
-        SELECT sql FROM sqlite_master
-        WHERE sql IS NOT NULL AND name NOT LIKE 'sqlite_%'
-        ORDER BY type, name
-    """).fetchall()
-    return '\n\n'.join(r['sql'] + ';' for r in rows), 200, \
-           {'Content-Type': 'text/plain; charset=utf-8'}
+    global _schema_cache
+    db  = get_db()
+    ver = db.execute("PRAGMA schema_version").fetchone()[0]
+    cached_ver, text = _schema_cache
+    if cached_ver != ver:
+        rows = db.execute("""
+            SELECT sql FROM sqlite_master
+            WHERE sql IS NOT NULL AND name NOT LIKE 'sqlite_%'
+            ORDER BY type, name
+        """).fetchall()
+        text = '\n\n'.join(r['sql'] + ';' for r in rows)
+        _schema_cache = (ver, text)
+    return Response(text, mimetype='text/plain')
 
 
 # ─────────────────────────────────────────
 #  STATIC
 # ─────────────────────────────────────────
 
+def load_page(path):
+    """
+    Reads a page once and keeps it in memory, plain and gzipped, with an
+    ETag. Serving it is then just handing over bytes — no file I/O or
+    compression per request. Edits to the file show up after a restart.
+    """
+    with open(os.path.join(app.root_path, path), 'rb') as f:
+        raw = f.read()
+    return {
+        'raw':  raw,
+        'gzip': gzip.compress(raw, 9),
+        'etag': hashlib.sha256(raw).hexdigest()[:32],
+    }
+
+INDEX_PAGE = load_page(os.path.join('public', 'index.html'))
+
 @app.route('/')
 def index():
-    return send_from_directory('public', 'index.html')
+    page = INDEX_PAGE
+    if request.accept_encodings['gzip']:
+        resp = app.response_class(page['gzip'], mimetype='text/html')
+        resp.headers['Content-Encoding'] = 'gzip'
+    else:
+        resp = app.response_class(page['raw'], mimetype='text/html')
+    resp.vary.add('Accept-Encoding')
+    # Browsers keep their copy but check the ETag each visit: unchanged
+    # pages cost a 304 with no body.
+    resp.cache_control.no_cache = True
+    resp.set_etag(page['etag'])
+    return resp.make_conditional(request)
 
 
 if __name__ == '__main__':
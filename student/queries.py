@@ -22,7 +22,11 @@ import sqlite3
 
 DB_PATH = 'classusd.db'
 
-conn = sqlite3.connect(DB_PATH)
+# Read-only: this script never takes a write lock, so it's safe to run
+# against the live database while the server is trading. (It also can't
+# change anything by accident.)
+conn = sqlite3.connect(f'file:{DB_PATH}?mode=ro', uri=True)
+conn.execute('PRAGMA mmap_size=268435456')
 conn.row_factory = sqlite3.Row
 cur  = conn.cursor()
 
@@ -54,8 +58,12 @@ rows = cur.fetchall()
 if rows:
     print(f"{'ID':<5} {'From':<15} {'To':<15} {'Coin':<10} {'Amount':<10} {'When'}")
     print("-" * 70)
-    for r in rows:
-        print(f"{r['trade_id']:<5} {r['from_user']:<15} {r['to_user']:<15} {r['symbol']:<10} {r['amount']:<10.4f} {r['executed_at']}")
+    # Build every line first and print them in one go: one print of a big
+    # string is much faster than thousands of small prints.
+    print("\n".join(
+        f"{r['trade_id']:<5} {r['from_user']:<15} {r['to_user']:<15} {r['symbol']:<10} {r['amount']:<10.4f} {r['executed_at']}"
+        for r in rows
+    ))
 else:
     print("No trades over 10 yet.")
 
@@ -86,8 +94,10 @@ rows = cur.fetchall()
 if rows:
     print(f"{'User':<18} {'Coin':<10} {'Balance':>12} {'Staked':>10} {'Burn Rate':>10}")
     print("-" * 60)
-    for r in rows:
-        print(f"{r['username']:<18} {r['symbol']:<10} {r['balance']:>12.4f} {r['staked']:>10.4f} {r['burn_rate']*100:>9.1f}%")
+    print("\n".join(
+        f"{r['username']:<18} {r['symbol']:<10} {r['balance']:>12.4f} {r['staked']:>10.4f} {r['burn_rate']*100:>9.1f}%"
+        for r in rows
+    ))
 else:
     print("No balances yet.")
 
@@ -117,8 +127,10 @@ rows = cur.fetchall()
 if rows:
     print(f"{'Symbol':<10} {'Name':<20} {'Trades':>7} {'Volume':>12} {'Burned':>10} {'Avg':>8}")
     print("-" * 75)
-    for r in rows:
-        print(f"{r['symbol']:<10} {r['name']:<20} {r['trade_count']:>7} {r['total_volume']:>12.4f} {r['total_burned']:>10.4f} {r['avg_trade_size']:>8.4f}")
+    print("\n".join(
+        f"{r['symbol']:<10} {r['name']:<20} {r['trade_count']:>7} {r['total_volume']:>12.4f} {r['total_burned']:>10.4f} {r['avg_trade_size']:>8.4f}"
+        for r in rows
+    ))
 else:
     print("No trades yet.")
 
@@ -146,8 +158,10 @@ rows = cur.fetchall()
 if rows:
     print(f"{'Symbol':<10} {'Name':<25} {'# Trades'}")
     print("-" * 45)
-    for r in rows:
-        print(f"{r['symbol']:<10} {r['name']:<25} {r['trade_count']}")
+    print("\n".join(
+        f"{r['symbol']:<10} {r['name']:<25} {r['trade_count']}"
+        for r in rows
+    ))
 else:
     print("No coins with more than 3 trades yet — keep trading!")
 
@@ -20,6 +20,7 @@ If any data changes, the hash breaks — and every block after it too.
 
 import sqlite3
 import hashlib
+from itertools import groupby
 
 DB_PATH = 'classusd.db'
 
@@ -44,6 +45,21 @@ def compute_hash(prev_hash, trade_id, from_user_id, to_user_id, coin_id, amount,
 # PART 2 — Verify one coin's chain
 # ════════════════════════════════════════════════════════════
 
+BLOCKS_QUERY = """
+    SELECT
+        lb.block_id,
+        lb.trade_id,
+        lb.prev_hash,
+        lb.this_hash,
+        lb.coin_id,
+        t.from_user_id,
+        t.to_user_id,
+        t.amount,
+        t.executed_at
+    FROM ledger_blocks lb
+    JOIN trades t ON lb.trade_id = t.trade_id
+"""
+
 def verify_chain(conn, coin_id, symbol):
     """
     Verifies the full blockchain for a single coin.
@@ -51,35 +67,44 @@ def verify_chain(conn, coin_id, symbol):
     Returns: (is_valid, first_bad_block_id, message)
     """
     cur = conn.cursor()
-    cur.execute("""
-        SELECT
-            lb.block_id,
-            lb.trade_id,
-            lb.prev_hash,
-            lb.this_hash,
-            lb.coin_id,
-            t.from_user_id,
-            t.to_user_id,
-            t.amount,
-            t.executed_at
-        FROM ledger_blocks lb
-        JOIN trades t ON lb.trade_id = t.trade_id
+    cur.execute(BLOCKS_QUERY + """
         WHERE lb.coin_id = ?
         ORDER BY lb.block_id ASC
     """, (coin_id,))
-    blocks = cur.fetchall()
+    return check_blocks(cur.fetchall(), symbol)
 
+
+def load_all_blocks(conn):
+    """
+    Every coin's blocks from ONE query, instead of one query per coin.
+    Returns: {coin_id: [block rows in block order]}
+    """
+    rows = conn.execute(BLOCKS_QUERY + """
+        ORDER BY lb.coin_id, lb.block_id ASC
+    """)
+    # Rows come sorted by coin, so groupby can split them into chains.
+    # Column 4 of each row is lb.coin_id.
+    return {coin_id: list(blocks) for coin_id, blocks in groupby(rows, key=lambda r: r[4])}
+
+
+def check_blocks(blocks, symbol):
+    """
+    Runs both checks over one coin's blocks, oldest first.
+
+    Returns: (is_valid, first_bad_block_id, message)
+    """
     if not blocks:
         return True, None, f"  {symbol}: No blocks yet."
 
-    genesis_prev = '0' * 64
+    # The first block links to the genesis hash; after that, each block
+    # must link to the hash of the block we just checked.
+    expected_prev = '0' * 64
 
-    for i, block in enumerate(blocks):
+    for block in blocks:
         block_id, trade_id, prev_hash, stored_hash, b_coin_id, \
             from_user_id, to_user_id, amount, executed_at = block
 
         # Check 1: does prev_hash link to previous block?
-        expected_prev = genesis_prev if i == 0 else blocks[i-1][3]
         if prev_hash != expected_prev:
             return False, block_id, (
                 f"  {symbol} BROKEN at block {block_id}: "
@@ -97,6 +122,8 @@ def verify_chain(conn, coin_id, symbol):
                 f"hash mismatch (data was changed after recording)"
             )
 
+        expected_prev = stored_hash
+
     return True, None, f"  {symbol}: ✅ {len(blocks)} blocks — all valid"
 
 
@@ -142,7 +169,10 @@ def print_chain(conn, coin_id, symbol):
 # ════════════════════════════════════════════════════════════
 
 if __name__ == '__main__':
-    conn = sqlite3.connect(DB_PATH)
+    # Read-only: safe to run against the live database while the server is
+    # trading, and it can't change the chain it's checking.
+    conn = sqlite3.connect(f'file:{DB_PATH}?mode=ro', uri=True)
+    conn.execute('PRAGMA mmap_size=268435456')
 
     # Get all coins
     coins = conn.execute("SELECT coin_id, symbol, name FROM coins ORDER BY coin_id").fetchall()
@@ -163,8 +193,9 @@ if __name__ == '__main__':
     print("  VERIFICATION RESULTS")
     print(f"{'='*62}")
 
+    blocks_by_coin = load_all_blocks(conn)
     for coin_id, symbol, name in coins:
-        is_valid, bad_block, msg = verify_chain(conn, coin_id, symbol)
+        is_valid, bad_block, msg = check_blocks(blocks_by_coin.get(coin_id, []), symbol)
         print(msg)
         if not is_valid:
             all_valid = False